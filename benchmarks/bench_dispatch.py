@@ -0,0 +1,42 @@
+# Per-statement cost of turning builtin calls into instructions.
+# Run from the repository root: python -m benchmarks.bench_dispatch [ROUNDS]
+import ast
+import sys
+import time
+
+from pyasm import parse
+
+STATEMENTS = [
+    'jump(target)',
+    'call(target)',
+    'add_value(3)',
+    'load_immediate(accum, 5)',
+    'load_immediate(regy, 7)',
+    'store_register(regx, 254)',
+    'increment_register(regy)',
+    'compare(accum, 255)',
+    'push(proc)',
+    'halt()',
+]
+
+
+def main() -> None:
+    problems = parse.check_stubs()
+    for problem in problems:
+        print('stub mismatch:', problem)
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    statements = [ast.parse(source).body[0] for source in STATEMENTS]
+    consts = {}
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for statement in statements:
+            parse._parse_code(statement, {}, None, consts)
+    elapsed = time.perf_counter() - start
+    count = rounds * len(statements)
+    print(f'{count} statements: {elapsed / count * 1e9:8.1f} ns/statement')
+    if problems:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
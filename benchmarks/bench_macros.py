@@ -0,0 +1,64 @@
+# Macro expansion throughput on a macro-heavy program.
+# Run from the repository root: python -m benchmarks.bench_macros [CALLS] [DEPTH]
+import ast
+import sys
+import time
+
+from pyasm import parse
+
+
+def make_source(calls: int, depth: int) -> str:
+    lines = ['from pyasm.stubs import *', '', '', '@inline_macro', 'def mac0(x, y):',
+             '    load_immediate(regx, x)', '    load_immediate(regy, y)', '    add_value(x)',
+             '    store_register(accum, y)', '    call(target)', '']
+    for level in range(1, depth):
+        lines += ['', '@inline_macro', f'def mac{level}(x, y):',
+                  f'    mac{level - 1}(x, y)', f'    mac{level - 1}(y, x)', '']
+    lines += ['', 'def start():']
+    lines += [f'    mac{depth - 1}({i & 0xff}, {(i * 7) & 0xff})' for i in range(calls)]
+    lines += ['', '', 'def target():', '    return', '']
+    return '\n'.join(lines)
+
+
+# parse._fill_macro as it was before macros were compiled into templates
+def legacy_fill_macro(macro, args):
+    copy = []
+    for item in macro:
+        item_copy = item.copy()
+        for (i, arg) in enumerate(item_copy.args):
+            if type(arg) == list:
+                if type(args[arg[0]]) == list:
+                    newarg = [args[arg[0]][0], arg[1] + args[arg[0]][1]]
+                else:
+                    newarg = arg[1] + args[arg[0]]
+                item_copy.args[i] = newarg
+        copy.append(item_copy)
+    return copy
+
+
+def main() -> None:
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    tree = ast.parse(make_source(calls, depth))
+    start = time.perf_counter()
+    program, macros, _, _ = parse.parse2(tree)
+    elapsed = time.perf_counter() - start
+    instructions = sum(len(label.codes) for label in program.labels)
+    print(f'{calls} calls to a depth-{depth} macro, {instructions} instructions')
+    print(f'parse2: {elapsed * 1000:8.1f} ms, {calls / elapsed:10.0f} expansions/s')
+
+    macro = macros[f'mac{depth - 1}']
+    values = ['1', '2']
+    for (name, expand) in [
+        ('legacy fill', lambda: legacy_fill_macro(macro.ops, dict(zip(macro.args, values)))),
+        ('template', lambda: macro.expand(values)),
+    ]:
+        start = time.perf_counter()
+        for _ in range(calls):
+            expand()
+        elapsed = time.perf_counter() - start
+        print(f'{name:12} {elapsed / calls * 1e6:8.2f} us/expansion ({len(macro.ops)} instructions)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Cycles per call of math.multiply on the simulator, against the repeated
+# addition routine it replaced.
+# Run from the repository root: python -m benchmarks.bench_multiply [STEP]
+# Operands run over 0..255 in steps of STEP (default: 15).
+import sys
+
+from pyasm import driver, objasm, opcodes, simulate
+
+CALLER = '''from pyasm.stubs import *
+{imports}
+
+def start():
+    load_immediate(regx, {x})
+    load_immediate(regy, {y})
+    call(multiply)
+    halt()
+'''
+
+# mult() with constant operands, which folds to a load of the product's low byte
+CONSTANT_CALLER = '''from pyasm.stubs import *
+from math import *
+
+def start():
+    mult({x}, {y})
+    halt()
+'''
+
+# builtin-modules/_math_mult.pyasm:multiply as it was before the shift-and-add rewrite
+LEGACY_MULTIPLY = '''
+MATH_MEMORY_REGe = 0x80fe
+MATH_MEMORY_REGf = 0x80ff
+
+
+def multiply():
+    store_register(regx, MATH_MEMORY_REGe)
+    store_register(regy, MATH_MEMORY_REGf)
+    load_immediate(regx, 0)
+    load_immediate(accum, 0)
+
+def _work_multiply_start():
+    compare(regx, MATH_MEMORY_REGf)
+    branch_ne(_work_multiply_loop)
+    jump(_end_multiply)
+
+def _work_multiply_loop():
+    add_memory(MATH_MEMORY_REGe)
+    increment_register(regx)
+    jump(_work_multiply_start)
+
+def _end_multiply():
+    return
+'''
+
+ROUTINES = {
+    # name -> (source after the caller, whether regy returns the high byte)
+    'repeated addition': (LEGACY_MULTIPLY, False),
+    'shift-and-add': ('', True),
+}
+
+
+def multiply_cycles(x: int, y: int, routine: str, high_byte: bool) -> int:
+    imports = 'from math import *' if not routine else ''
+    source = CALLER.format(imports=imports, x=x, y=y) + routine
+    result = driver.compile_source(source, '<bench>', driver.Options(), with_assembly=True)
+    sim = simulate.simulate(result.assembly)
+    product = x * y
+    if sim.registers['a'] != product & 0xff or (high_byte and sim.registers['y'] != product >> 8):
+        raise AssertionError(f'{x} * {y}: got A={sim.registers["a"]} Y={sim.registers["y"]}')
+    # everything but the caller's loads and the halt
+    return sum(stats.cycles for (name, stats) in sim.labels.items() if name != 'start')
+
+
+def constant_cycles(x: int, y: int) -> int:
+    # start is the folded code followed by halt()'s jmp
+    source = CONSTANT_CALLER.format(x=x, y=y)
+    result = driver.compile_source(source, '<bench>', driver.Options(), with_assembly=True)
+    sim = simulate.simulate(result.assembly)
+    if sim.registers['a'] != x * y & 0xff:
+        raise AssertionError(f'mult({x}, {y}): got A={sim.registers["a"]}')
+    return sim.labels['start'].cycles - opcodes.instruction_cycles('jmp', [objasm.HALT_LABEL])
+
+
+def main() -> None:
+    step = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    operands = range(0, 256, step)
+    print(f'{"routine":20} {"min":>8} {"mean":>8} {"max":>8}   cycles inside the routine per call')
+    for (name, (routine, high_byte)) in ROUTINES.items():
+        cycles = [multiply_cycles(x, y, routine, high_byte) for x in operands for y in operands]
+        print(f'{name:20} {min(cycles):8} {sum(cycles) / len(cycles):8.1f} {max(cycles):8}')
+    cycles = [constant_cycles(x, y) for x in operands for y in operands]
+    print(f'{"constant operands":20} {min(cycles):8} {sum(cycles) / len(cycles):8.1f} {max(cycles):8}')
+
+
+if __name__ == '__main__':
+    main()
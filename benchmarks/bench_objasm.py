@@ -0,0 +1,54 @@
+# Memory and construction cost of the objasm IR.
+# Run from the repository root: python -m benchmarks.bench_objasm [COUNT]
+import sys
+import time
+import tracemalloc
+
+from pyasm import objasm
+
+
+# objasm.OpCode as it was before the nodes were slotted
+class DictOpCode:
+    def __init__(self, **kwargs) -> None:
+        self.__dict__.update(kwargs)
+
+
+MNEMONICS = ['lda', 'ldx', 'ldy', 'sta', 'stx', 'sty', 'adc', 'jsr', 'jmp', 'bne']
+
+
+def build(make, count: int) -> list:
+    return [make(op=''.join(MNEMONICS[i % len(MNEMONICS)]), args=[str(i & 0xff)]) for i in range(count)]
+
+
+def build_packed(count: int) -> objasm.PackedProgram:
+    packed = objasm.PackedProgram()
+    packed.add_label('start')
+    for i in range(count):
+        packed.add_op(''.join(MNEMONICS[i % len(MNEMONICS)]), [str(i & 0xff)])
+    return packed
+
+
+def measure(make, count: int) -> tuple[float, float]:
+    start = time.perf_counter()
+    build(make, count) if make is not None else build_packed(count)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    ops = build(make, count) if make is not None else build_packed(count)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del ops
+    return used / count, elapsed / count * 1e9
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    print(f'{count} instructions')
+    for (name, make) in [('dict (before)', DictOpCode), ('slots (after)', objasm.OpCode),
+                       ('packed', None)]:
+        per_op, ns = measure(make, count)
+        print(f'{name:14} {per_op:8.1f} bytes/instruction {ns:8.1f} ns/instruction')
+
+
+if __name__ == '__main__':
+    main()
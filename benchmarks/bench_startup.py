@@ -0,0 +1,76 @@
+# Wall time and import time of short command line runs.
+# Run from the repository root: python -m benchmarks.bench_startup [RUNS]
+# Run `python -m pyasm --prebuild` first to measure with prebuilt builtin modules.
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from pyasm import parse
+
+PROGRAMS = {
+    'trivial': 'from pyasm.stubs import *\ndef start():\n    load_immediate(accum, 1)\n',
+    'builtin-import': 'from pyasm.stubs import *\nfrom math import *\ndef start():\n    load_immediate(accum, 1)\n',
+}
+
+TOP_IMPORTS = 12
+
+
+def run(args: list[str], env: dict[str, str]) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable] + args, env=env, capture_output=True, text=True, check=True)
+
+
+def best_time(args: list[str], env: dict[str, str], runs: int, cold_root: str = None) -> float:
+    # with cold_root, every run gets a new empty cache directory under it
+    best = float('inf')
+    for i in range(runs):
+        if cold_root is not None:
+            env = dict(env, PYASM_CACHE_DIR=os.path.join(cold_root, f'cold-{i}'))
+        start = time.perf_counter()
+        run(args, env)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def import_times(args: list[str], env: dict[str, str]) -> list[tuple[int, int, str]]:
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    stderr = run(['-X', 'importtime'] + args, env).stderr
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(own), int(cumulative), name.strip()))
+    return times
+
+
+def main() -> None:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    prebuilt = os.path.isdir(os.path.join(parse.BUILTIN_MODULE_DIR, '__prebuilt__'))
+    print(f'prebuilt builtin modules: {"yes" if prebuilt else "no"}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = {}
+        for (name, source) in PROGRAMS.items():
+            paths[name] = os.path.join(tmpdir, name + '.pyasm')
+            with open(paths[name], 'w') as fp:
+                fp.write(source)
+        warm_env = dict(env, PYASM_CACHE_DIR=os.path.join(tmpdir, 'cache'))
+        python = best_time(['-c', 'pass'], env, runs)
+        print(f'{"python -c pass":36} {python * 1e3:8.1f} ms')
+        for (name, path) in paths.items():
+            args = ['-m', 'pyasm', '-o', os.devnull, path]
+            warm = best_time(args, warm_env, runs)
+            cold = best_time(args, env, runs, os.path.join(tmpdir, name))
+            print(f'{name + " (warm cache)":36} {warm * 1e3:8.1f} ms')
+            print(f'{name + " (cold cache)":36} {cold * 1e3:8.1f} ms')
+        times = import_times(['-m', 'pyasm', '-o', os.devnull, paths['trivial']], warm_env)
+    print(f'\nimports of a trivial run: {len(times)} modules, {sum(own for (own, _, _) in times) / 1e3:.1f} ms')
+    for (own, cumulative, name) in sorted(times, reverse=True)[:TOP_IMPORTS]:
+        print(f'{name:36} {own / 1e3:8.2f} ms {cumulative / 1e3:8.2f} ms cumulative')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# Phase timings on generated programs, written as JSON so runs on different
+# commits can be compared.
+# Run from the repository root:
+#   python -m benchmarks.bench_suite [-o results.json] [--compare baseline.json]
+#   python -m benchmarks.bench_suite --generate DIR --case large   (just write the program)
+import argparse
+import ast
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from pyasm import cache, generate, parse
+
+IMPORT_SHAPES = ['star', 'chain', 'tree']
+
+# name -> generator parameters; every module gets `functions` functions
+CASES = {
+    'small': dict(functions=20, instructions=10, macro_depth=1, consts=10, modules=1, shape='star'),
+    'large': dict(functions=400, instructions=40, macro_depth=2, consts=200, modules=4, shape='star'),
+    'deep-macros': dict(functions=100, instructions=20, macro_depth=6, consts=20, modules=1, shape='star'),
+    'many-consts': dict(functions=100, instructions=20, macro_depth=1, consts=5000, modules=1, shape='star'),
+    'import-chain': dict(functions=30, instructions=20, macro_depth=2, consts=20, modules=24, shape='chain'),
+    'import-tree': dict(functions=30, instructions=20, macro_depth=2, consts=20, modules=31, shape='tree'),
+}
+
+PHASES = ['ast.parse', 'parse.parse2', 'macro expansion', 'generate.generate_asm']
+
+# a phase counts as a regression when it got this much slower
+REGRESSION_THRESHOLD = 0.10
+
+
+def module_name(i: int) -> str:
+    return f'bench_mod{i}'
+
+
+def module_imports(i: int, modules: int, shape: str) -> list[int]:
+    # i == -1 is the entry module
+    if shape == 'star':
+        return list(range(modules)) if i == -1 else []
+    if shape == 'chain':
+        return [i + 1] if i + 1 < modules else []
+    # tree: a binary tree of modules under the entry module
+    children = [0] if i == -1 else [2 * i + 1, 2 * i + 2]
+    return [child for child in children if child < modules]
+
+
+def make_module(prefix: str, imports: list[int], functions: int, instructions: int,
+                macro_depth: int, consts: int, entry_calls: list[str] = None) -> str:
+    lines = ['from pyasm.stubs import *']
+    lines += [f'from {module_name(i)} import *' for i in imports]
+    lines.append('')
+    for i in range(consts):
+        lines.append(f'{prefix}_C{i} = {(i * 37) & 0xff}')
+    for level in range(macro_depth):
+        lines += ['', '', '@inline_macro', f'def {prefix}_mac{level}(x, y):']
+        if level:
+            lines += [f'    {prefix}_mac{level - 1}(x, y)', f'    {prefix}_mac{level - 1}(y, x)']
+        else:
+            lines += ['    load_immediate(accum, x)', '    add_value(y)', '    store_register(accum, 512)']
+    statements = [
+        lambda f, k: f'load_immediate(accum, {prefix}_C{k % consts})' if consts else 'load_immediate(accum, 1)',
+        lambda f, k: f'store_register(regx, {512 + k % 256})',
+        lambda f, k: f'call({prefix}_fn{(f + k + 1) % functions})',
+        lambda f, k: f'{prefix}_mac{macro_depth - 1}({k & 0xff}, {prefix}_C{k % consts})'
+        if macro_depth and consts else 'increment_register(regy)',
+        lambda f, k: 'increment_register(regy)',
+        lambda f, k: f'compare(accum, {k & 0xff})',
+        lambda f, k: f'branch_ne({prefix}_fn{f})',
+    ]
+    if entry_calls is not None:
+        # the entry module's first label is where the program starts
+        lines += ['', '', 'def start():'] + [f'    call({target})' for target in entry_calls] + ['    halt()']
+    for f in range(functions):
+        lines += ['', '', f'def {prefix}_fn{f}():']
+        for k in range(instructions):
+            lines.append('    ' + statements[(f + k) % len(statements)](f, k))
+        lines.append('    return')
+    return '\n'.join(lines) + '\n'
+
+
+def generate_project(dirpath: str, functions: int, instructions: int, macro_depth: int,
+                     consts: int, modules: int, shape: str) -> str:
+    # writes the entry module and its libraries to dirpath, returns the entry path
+    if shape not in IMPORT_SHAPES:
+        raise ValueError(f'unknown import shape {shape!r}')
+    os.makedirs(dirpath, exist_ok=True)
+    for i in range(modules):
+        source = make_module(f'm{i}', module_imports(i, modules, shape), functions, instructions, macro_depth, consts)
+        with open(os.path.join(dirpath, module_name(i) + '.pyasm'), 'w') as fp:
+            fp.write(source)
+    entry_calls = ['main_fn0'] + [f'm{i}_fn0' for i in range(modules)]
+    source = make_module('main', module_imports(-1, modules, shape), functions, instructions, macro_depth, consts,
+                         entry_calls)
+    entry = os.path.join(dirpath, 'main.pyasm')
+    with open(entry, 'w') as fp:
+        fp.write(source)
+    return entry
+
+
+def macro_calls(trees: list[ast.Module], macros: parse.MacroDict) -> list[ast.Call]:
+    # call sites in ordinary functions; calls inside macro bodies are part of parsing the macro
+    functions = [node for tree in trees for node in tree.body
+                 if type(node) == ast.FunctionDef and not node.decorator_list]
+    return [node for fn in functions for node in ast.walk(fn)
+            if type(node) == ast.Call and type(node.func) == ast.Name and node.func.id in macros]
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_case(params: dict, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        entry = generate_project(tmpdir, **params)
+        sources = []
+        for filename in sorted(os.listdir(tmpdir)):
+            with open(os.path.join(tmpdir, filename)) as fp:
+                sources.append(fp.read())
+        with open(entry) as fp:
+            entry_source = fp.read()
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        parse.invalidate_module_index()
+        try:
+            timings = {}
+            timings['ast.parse'] = best_of(lambda: [ast.parse(source) for source in sources], repeat)
+            entry_tree = ast.parse(entry_source)
+            timings['parse.parse2'] = best_of(lambda: parse.parse2(entry_tree), repeat)
+            program, macros, consts, _ = parse.parse2(entry_tree)
+            calls = macro_calls([ast.parse(source) for source in sources], macros)
+            timings['macro expansion'] = best_of(
+                lambda: [parse._parse_pycall(call, macros, None, consts) for call in calls], repeat)
+            timings['generate.generate_asm'] = best_of(lambda: generate.generate_asm(program), repeat)
+        finally:
+            os.chdir(cwd)
+            parse.invalidate_module_index()
+    return {
+        'params': params,
+        'labels': len(program.labels),
+        'instructions': sum(len(label.codes) for label in program.labels),
+        'macro_calls': len(calls),
+        'seconds': timings,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> list[str]:
+    print(f'\n{"case":16} {"phase":24} {"baseline":>10} {"current":>10} {"change":>8}')
+    regressions = []
+    for (name, case) in results['cases'].items():
+        if (old := baseline['cases'].get(name)) is None:
+            continue
+        if old['params'] != case['params']:
+            print(f'{name:16} generator parameters changed, not compared')
+            continue
+        for phase in PHASES:
+            before, after = old['seconds'].get(phase), case['seconds'].get(phase)
+            if not before or after is None:
+                continue
+            change = after / before - 1
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append(f'{name}: {phase}')
+            print(f'{name:16} {phase:24} {before * 1e3:8.2f}ms {after * 1e3:8.2f}ms {change:+7.1%}{flag}')
+    return regressions
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(prog='python -m benchmarks.bench_suite')
+    argparser.add_argument('--case', action='append', choices=list(CASES),
+                           help='run only this case; may be repeated (default: every case)')
+    argparser.add_argument('--repeat', type=int, default=5, help='timed runs per phase, the best one counts')
+    argparser.add_argument('-o', '--output', metavar='FILE', help='write the results as JSON to FILE')
+    argparser.add_argument('--compare', metavar='FILE', help='compare against results written earlier')
+    argparser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                           help='relative slowdown reported as a regression (default: 0.10)')
+    argparser.add_argument('--generate', metavar='DIR', help='only write the program of the first case to DIR')
+    args = argparser.parse_args()
+    names = args.case or list(CASES)
+    if args.generate:
+        print(generate_project(args.generate, **CASES[names[0]]))
+        return
+    # time the compiler itself, not the module cache
+    cache.ENABLED = False
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'repeat': args.repeat,
+        'cases': {},
+    }
+    print(f'{"case":16} {"labels":>7} {"instrs":>8} ' + ' '.join(f'{phase:>22}' for phase in PHASES))
+    for name in names:
+        case = results['cases'][name] = run_case(CASES[name], args.repeat)
+        timings = ' '.join(f'{case["seconds"][phase] * 1e3:20.2f}ms' for phase in PHASES)
+        print(f'{name:16} {case["labels"]:7} {case["instructions"]:8} {timings}')
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(results, json.load(fp), args.threshold)
+        if regressions:
+            print('\nregressions: ' + ', '.join(regressions))
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,155 @@
-import ast
+import argparse
+import os
 import sys
 
-from pyasm import errors, generate, parse
+from pyasm import cache, driver, errors, instrument, parse
 
-with open(sys.argv[1]) as fp:
-    contents = fp.read()
+
+def _help_formatter(prog: str) -> argparse.HelpFormatter:
+    # argparse would measure the terminal through shutil on every run, and
+    # importing shutil costs more than most compiles
     try:
-        print(generate.generate_asm(parse.parse(ast.parse(contents, sys.argv[1]))))
-    except errors.PyASMError as e:
-        lines = contents.splitlines()
-        line = lines[e.lineno - 1]
-        print('error in file', f'{sys.argv[1]}:{e.lineno}')
-        print('  ', line)
-        if isinstance(e, errors.UnsupportedSyntaxElement):
-            print(' ', ' ' * e.colno, '^')
-        print(e.__class__.__qualname__ + ':', e.args[0])
+        columns = int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        try:
+            columns = os.get_terminal_size(sys.__stdout__.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            columns = 80
+    return argparse.HelpFormatter(prog, width=columns - 2)
+
+
+argparser = argparse.ArgumentParser(prog='python -m pyasm', formatter_class=_help_formatter)
+argparser.add_argument('files', metavar='file', nargs='*',
+                       help='entry files to compile; several files are compiled as a batch')
+argparser.add_argument('-o', '--output', metavar='FILE',
+                       help='write the output to FILE instead of stdout')
+argparser.add_argument('-f', '--format', choices=['asm', 'bin', 'hex'], default='asm',
+                       help='output textual assembly, a raw binary or Intel HEX (default: asm)')
+argparser.add_argument('--hex', action='store_true',
+                       help='write numbers in the assembly output as $hex instead of decimal')
+argparser.add_argument('--origin', type=lambda s: int(s, 0),
+                       help='load address of the binary output (default: 0x0600)')
+argparser.add_argument('--library-origin', type=lambda s: int(s, 0), metavar='ADDRESS',
+                       help='place imported library code at ADDRESS instead of right after the entry code')
+argparser.add_argument('-O', dest='opt_level', metavar='LEVEL', type=int, default=0,
+                       help='optimization level; 0 disables optimization, 2 also inlines small subroutines and '
+                            'drops redundant loads and stores (default: 0)')
+argparser.add_argument('--opt-report', action='store_true',
+                       help='print what each optimization saved to stderr')
+argparser.add_argument('--zp-report', action='store_true',
+                       help='print how many instructions use zero-page addressing and which named '
+                            'addresses would gain from moving into zero page to stderr')
+argparser.add_argument('--simulate', action='store_true',
+                       help='run the program on the built-in 6502 simulator and report cycle counts')
+argparser.add_argument('--max-cycles', type=int,
+                       help='stop the simulation after this many cycles (default: 100000000)')
+argparser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                       help='compile a batch with N worker processes; 0 uses every CPU (default: 1)')
+argparser.add_argument('--output-dir', metavar='DIR',
+                       help='write batch outputs to DIR instead of next to each input')
+argparser.add_argument('--watch', action='store_true',
+                       help='keep running and recompile whenever an input or an imported module changes')
+argparser.add_argument('--max-errors', type=int, metavar='N',
+                       help='keep compiling after errors and report up to N of them; 0 reports all '
+                            '(default: stop at the first error)')
+argparser.add_argument('--error-format', choices=['text', 'json'], default='text',
+                       help='print errors as text or as a JSON list for editors (default: text)')
+argparser.add_argument('--profile', action='store_true',
+                       help='print time per phase and per module and internal counters to stderr')
+argparser.add_argument('--profile-format', choices=['text', 'json'], default='text',
+                       help='format of the --profile report (default: text)')
+argparser.add_argument('--no-cache', action='store_true',
+                       help='parse imported modules from source instead of using the module cache')
+argparser.add_argument('--clear-cache', action='store_true',
+                       help='remove all cached modules before compiling')
+argparser.add_argument('--prebuild', action='store_true',
+                       help='store the builtin modules in prebuilt form so they load without parsing; run after installing')
+argparser.add_argument('--which', metavar='MODULE', action='append', default=[],
+                       help='show which file an import of MODULE resolves to and what it shadows')
+args = argparser.parse_args()
+
+if args.clear_cache:
+    cache.clear()
+if args.no_cache:
+    cache.ENABLED = False
+if args.prebuild:
+    for filepath in parse.prebuild():
+        print('prebuilt', filepath)
+for name in args.which:
+    candidates = parse.module_index().candidates(name)
+    if not candidates:
+        print(f'{name}: not found')
+        continue
+    print(f'{name}: {candidates[0]}')
+    for shadowed in candidates[1:]:
+        print('  shadows', shadowed)
+if not args.files:
+    if not (args.clear_cache or args.which or args.prebuild):
+        argparser.error('the following arguments are required: file')
+    raise SystemExit
+
+options = driver.Options(format=args.format, origin=args.origin, library_origin=args.library_origin,
+                         opt_level=args.opt_level, output_dir=args.output_dir, max_errors=args.max_errors,
+                         hex=args.hex)
+
+# reports that only make sense for a single compile of a single file
+single_compile_flags = (('--simulate', args.simulate), ('--opt-report', args.opt_report),
+                        ('--zp-report', args.zp_report), ('--profile', args.profile),
+                        ('--error-format json', args.error_format == 'json'))
+
+if args.watch:
+    for (flag, value) in (('-o', args.output and len(args.files) > 1), ('-j', args.jobs != 1)) + single_compile_flags:
+        if value:
+            argparser.error(f'{flag} cannot be used with --watch')
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    try:
+        driver.Watcher(args.files, options, args.output).run()
+    except KeyboardInterrupt:
+        pass
+    raise SystemExit
+
+if len(args.files) > 1 or args.output_dir is not None or args.jobs != 1:
+    for (flag, value) in (('-o', args.output),) + single_compile_flags:
+        if value:
+            argparser.error(f'{flag} cannot be used when compiling a batch')
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if driver.run_batch(args.files, options, min(jobs, len(args.files))):
+        raise SystemExit(1)
+    raise SystemExit
+
+if args.profile:
+    instrument.start()
+
+filename = args.files[0]
+with open(filename) as fp:
+    contents = fp.read()
+try:
+    result = driver.compile_source(contents, filename, options, with_assembly=args.simulate)
+    if args.opt_report and args.opt_level > 0:
+        print(result.report.format(), file=sys.stderr)
+    if args.zp_report:
+        from pyasm import assemble
+        print(assemble.addressing_report(result.program).format(result.consts), file=sys.stderr)
+    if args.simulate:
+        from pyasm import simulate
+        max_cycles = args.max_cycles if args.max_cycles is not None else simulate.DEFAULT_MAX_CYCLES
+        sim_result = simulate.simulate(result.assembly, max_cycles=max_cycles)
+except (errors.PyASMError, SyntaxError) as e:
+    if args.error_format == 'json':
+        import json
+        print(json.dumps(driver.error_records(e, filename), indent=2))
+    else:
+        print(driver.format_error(e, filename, contents))
+    raise SystemExit(1)
+if args.simulate:
+    print(simulate.format_report(sim_result, [label.name for label in result.program.labels if label.reserve]))
+if args.output is not None:
+    driver.write_result(result, options, path=args.output)
+elif not args.simulate:
+    driver.write_result(result, options, sys.stdout)
+    if options.format == 'asm':
+        print()
+if args.profile:
+    profile = instrument.stop()
+    print(profile.to_json() if args.profile_format == 'json' else profile.format(), file=sys.stderr)
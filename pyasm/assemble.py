@@ -0,0 +1,151 @@
+import struct
+
+from pyasm import errors, objasm, opcodes
+
+DEFAULT_ORIGIN = 0x0600
+
+_pack_op_byte = struct.Struct('<BB').pack_into
+_pack_op_branch = struct.Struct('<Bb').pack_into
+_pack_op_word = struct.Struct('<BH').pack_into
+
+
+class Assembly:
+    origin: int
+    data: bytearray
+    labels: dict[str, int]
+
+    def __init__(self, origin: int, data: bytearray, labels: dict[str, int]) -> None:
+        self.origin = origin
+        self.data = data
+        self.labels = labels
+
+
+def assemble(program: objasm.Program, origin: int = DEFAULT_ORIGIN) -> Assembly:
+    # pass 1: every instruction's size is known from its operand syntax alone,
+    # so label addresses can be assigned before any operand is resolved
+    addresses = {}
+    plan = []
+    pc = origin
+    for label in program.labels:
+        if label.origin is not None:
+            if label.origin < pc:
+                raise errors.AssembleError.create_custom(
+                    f'code before it already reaches ${pc:04x}, past its origin ${label.origin:04x}', label.name)
+            pc = label.origin
+        for name in label.names:
+            addresses[name] = pc
+        for op in objasm.label_codes(label):
+            modes = opcodes.OPCODES.get(op.op)
+            if modes is None:
+                raise errors.AssembleError.create_custom(f'unknown instruction {op.op!r}', label.name)
+            mode, value = opcodes.parse_operand(op.op, op.args)
+            if mode not in modes:
+                raise errors.AssembleError.create_custom(
+                    f'{op.op!r} does not support the {mode!r} addressing mode', label.name)
+            plan.append((pc, modes[mode][0], mode, value, label.name))
+            pc += opcodes.MODE_SIZES[mode]
+        pc += label.reserve
+    if pc > 0x10000:
+        raise errors.AssembleError.create_custom(f'program ends at ${pc:x}, past the end of memory')
+
+    # pass 2: write straight into one preallocated buffer
+    data = bytearray(pc - origin)
+    for (pc, opcode, mode, value, where) in plan:
+        if type(value) == str:
+            if (address := addresses.get(value)) is None:
+                raise errors.AssembleError.create_custom(f'undefined label {value!r}', where)
+            value = address
+        offset = pc - origin
+        size = opcodes.MODE_SIZES[mode]
+        if size == 1:
+            data[offset] = opcode
+        elif mode == 'rel':
+            delta = value - (pc + 2)
+            if not -128 <= delta <= 127:
+                raise errors.AssembleError.create_custom(f'branch target ${value:04x} is out of range', where)
+            _pack_op_branch(data, offset, opcode, delta)
+        elif size == 2:
+            if not -128 <= value <= 0xff:
+                raise errors.AssembleError.create_custom(f'operand {value} does not fit in a byte', where)
+            _pack_op_byte(data, offset, opcode, value & 0xff)
+        else:
+            if not 0 <= value <= 0xffff:
+                raise errors.AssembleError.create_custom(f'address {value} is out of range', where)
+            _pack_op_word(data, offset, opcode, value)
+    return Assembly(origin, data, addresses)
+
+
+# a named absolute address used by at least this many instructions that have a
+# zero-page form is worth moving into zero page
+HOT_ADDRESS_USES = 2
+
+_ABSOLUTE_FORMS = {zp: wide for (wide, zp) in opcodes.ZERO_PAGE_FORMS.items()}
+
+
+class AddressingReport:
+    zero_page: int
+    absolute: int
+    # what the zero-page instructions save over their absolute forms
+    bytes_saved: int
+    cycles_saved: int
+    # absolute address -> (instructions that have a zero-page form, bytes, cycles)
+    absolute_uses: dict[int, tuple[int, int, int]]
+
+    def __init__(self) -> None:
+        self.zero_page = 0
+        self.absolute = 0
+        self.bytes_saved = 0
+        self.cycles_saved = 0
+        self.absolute_uses = {}
+
+    def format(self, consts: dict[str, str] = None) -> str:
+        lines = [f'zero page: {self.zero_page} of {self.zero_page + self.absolute} memory operands '
+                 f'({self.bytes_saved} bytes and {self.cycles_saved} cycles per pass saved)']
+        names = {}
+        for (name, value) in (consts or {}).items():
+            if type(value := opcodes.parse_value(value)) == int:
+                names.setdefault(value, []).append(name)
+        hot = sorted(self.absolute_uses.items(), key=lambda item: (-item[1][2], item[0]))
+        for (address, (uses, nbytes, cycles)) in hot:
+            if uses >= HOT_ADDRESS_USES and address in names:
+                lines.append(f'warning: {" / ".join(names[address])} (${address:04x}) is used by {uses} '
+                             f'instructions; in zero page it would save {nbytes} bytes and {cycles} cycles per pass')
+        return '\n'.join(lines)
+
+
+def addressing_report(program: objasm.Program) -> AddressingReport:
+    report = AddressingReport()
+    for label in program.labels:
+        for op in label.codes:
+            if (modes := opcodes.OPCODES.get(op.op)) is None:
+                continue
+            mode, value = opcodes.parse_operand(op.op, op.args)
+            if (absolute := _ABSOLUTE_FORMS.get(mode)) is not None:
+                report.zero_page += 1
+                report.bytes_saved += 1
+                report.cycles_saved += modes[absolute][1] - modes[mode][1]
+            elif type(value) == int and (zp := opcodes.ZERO_PAGE_FORMS.get(mode)) in modes:
+                report.absolute += 1
+                uses, nbytes, cycles = report.absolute_uses.get(value, (0, 0, 0))
+                report.absolute_uses[value] = (uses + 1, nbytes + 1, cycles + modes[mode][1] - modes[zp][1])
+    return report
+
+
+def to_intel_hex(data: bytes, origin: int = 0, record_size: int = 16) -> str:
+    lines = []
+    view = memoryview(data)
+    for offset in range(0, len(data), record_size):
+        chunk = view[offset:offset + record_size]
+        address = origin + offset
+        record = bytes((len(chunk), address >> 8 & 0xff, address & 0xff, 0x00)) + chunk
+        lines.append(':' + record.hex().upper() + f'{-sum(record) & 0xff:02X}')
+    lines.append(':00000001FF')
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    from pyasm import parse
+    import ast
+    import sys
+    assembly = assemble(parse.parse(ast.parse(open(sys.argv[1]).read())))
+    sys.stdout.write(to_intel_hex(assembly.data, assembly.origin))
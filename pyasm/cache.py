@@ -0,0 +1,174 @@
+import os
+from typing import Any, Callable, Union
+
+CACHE_VERSION = 11
+
+ENABLED = True
+
+# import name -> the file it resolves to now, or None
+Resolver = Callable[[str], Union[str, None]]
+
+
+def cache_dir() -> str:
+    if (path := os.environ.get('PYASM_CACHE_DIR')):
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pyasm')
+
+
+# Startup matters for short programs, so modules that only some runs need
+# (hashlib, pickle, shutil) are imported where they are used.
+
+
+def clear() -> None:
+    import shutil
+    shutil.rmtree(cache_dir(), ignore_errors=True)
+
+
+def file_digest(filepath: str) -> str:
+    import hashlib
+    with open(filepath, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def file_stamp(filepath: str) -> tuple[int, int, str]:
+    st = os.stat(filepath)
+    return st.st_size, st.st_mtime_ns, file_digest(filepath)
+
+
+def _is_fresh(deps: dict[str, tuple[int, int, str]]) -> bool:
+    for (filepath, (size, mtime, digest)) in deps.items():
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return False
+        if st.st_size == size and st.st_mtime_ns == mtime:
+            continue
+        # mtime changes on a checkout or touch; only the content decides
+        if st.st_size != size or file_digest(filepath) != digest:
+            return False
+    return True
+
+
+def _resolves_same(imports: dict[str, str], resolve: Union[Resolver, None]) -> bool:
+    # a module that now shadows an import (or its removal) changes what the
+    # entry was built from without touching any of its dependencies
+    if resolve is None:
+        return True
+    return all(resolve(name) == path for (name, path) in imports.items())
+
+
+def _current_value(entry: Any, resolve: Union[Resolver, None]) -> Union[Any, None]:
+    # entries of another version may not even have the same fields
+    if entry is None or entry[0] != CACHE_VERSION:
+        return None
+    _, deps, imports, value = entry
+    if not _is_fresh(deps) or not _resolves_same(imports, resolve):
+        return None
+    return value
+
+
+def _key_path(key: str) -> str:
+    import hashlib
+    return os.path.join(cache_dir(), hashlib.sha1(key.encode()).hexdigest() + '.pickle')
+
+
+def _entry_path(filepath: str, variant: Any) -> str:
+    return _key_path(f'{os.path.abspath(filepath)}\0{variant!r}')
+
+
+def _index_path() -> str:
+    return os.path.join(cache_dir(), 'module-index.pickle')
+
+
+def _write(path: str, value: Any) -> None:
+    import pickle
+    tmppath = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmppath, 'wb') as fp:
+            pickle.dump(value, fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, path)
+    except OSError:
+        # a read-only or full cache directory must never break a compile
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+
+
+def _read(path: str) -> Any:
+    import pickle
+    try:
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError):
+        return None
+
+
+# Entries keep the path every import resolved to; load() takes the function
+# that resolves them now and ignores the entry if any of them moved.
+def load(filepath: str, variant: Any = None,
+         resolve: Union[Resolver, None] = None) -> Union[Any, None]:
+    if not ENABLED:
+        return None
+    return _current_value(_read(_entry_path(filepath, variant)), resolve)
+
+
+def store(filepath: str, deps: dict[str, tuple[int, int, str]], value: Any, variant: Any = None,
+          imports: dict[str, str] = None) -> None:
+    if ENABLED:
+        _write(_entry_path(filepath, variant), (CACHE_VERSION, deps, imports or {}, value))
+
+
+# Prebuilt modules live next to their source in a __prebuilt__ directory, like
+# __pycache__. They are written once by `python -m pyasm --prebuild` after
+# installing, so the builtin modules load without parsing even when the user
+# cache is cold or not writable. Like cache entries, they are only used while
+# every file they were built from is unchanged and every import still resolves
+# to the same file.
+def _prebuilt_path(filepath: str) -> str:
+    dirname, filename = os.path.split(os.path.abspath(filepath))
+    return os.path.join(dirname, '__prebuilt__', filename + '.pickle')
+
+
+def load_prebuilt(filepath: str, resolve: Union[Resolver, None] = None) -> Union[Any, None]:
+    if not ENABLED:
+        return None
+    path = _prebuilt_path(filepath)
+    if not os.path.exists(path):
+        return None
+    return _current_value(_read(path), resolve)
+
+
+def store_prebuilt(filepath: str, deps: dict[str, tuple[int, int, str]], value: Any,
+                   imports: dict[str, str] = None) -> None:
+    _write(_prebuilt_path(filepath), (CACHE_VERSION, deps, imports or {}, value))
+
+
+# The module index keeps one listing per search directory together with the
+# directory's mtime, which changes whenever an entry is added or removed.
+def load_index(dirnames: list[str]) -> Union[dict[str, tuple[int, dict]], None]:
+    if not ENABLED:
+        return None
+    entry = _read(_index_path())
+    if entry is None or entry[0] != CACHE_VERSION:
+        return None
+    listings = entry[1]
+    return {dirname: listings[dirname] for dirname in dirnames if dirname in listings}
+
+
+def store_index(dirnames: list[str], listings: dict[str, tuple[int, dict]]) -> None:
+    if not ENABLED:
+        return
+    entry = _read(_index_path())
+    merged = entry[1] if entry is not None and entry[0] == CACHE_VERSION else {}
+    merged.update(listings)
+    _write(_index_path(), (CACHE_VERSION, merged))
+
+
+def clear_index() -> None:
+    try:
+        os.remove(_index_path())
+    except OSError:
+        pass
@@ -0,0 +1,322 @@
+import ast
+import os
+import sys
+import time
+from typing import Optional, TextIO, Union
+
+from pyasm import cache, errors, generate, instrument, objasm, parse
+
+# seconds between checks for changed files in watch mode
+WATCH_INTERVAL = 0.2
+
+OUTPUT_EXTS = {
+    'asm': '.s',
+    'bin': '.bin',
+    'hex': '.hex',
+}
+
+
+class Options:
+    format: str = 'asm'
+    # None places the code at assemble.DEFAULT_ORIGIN
+    origin: Optional[int] = None
+    library_origin: Optional[int] = None
+    opt_level: int = 0
+    output_dir: Optional[str] = None
+    # None stops at the first error, 0 collects every error
+    max_errors: Optional[int] = None
+    # write numeric operands of textual assembly as $hex
+    hex: bool = False
+
+    def __init__(self, **kwargs) -> None:
+        self.__dict__.update(kwargs)
+
+
+class Result:
+    program: objasm.Program
+    assembly: Optional['assemble.Assembly']
+    # only set when optimizing
+    report: Optional['optimize.Report']
+    # every constant the compiled file can see
+    consts: dict[str, str]
+
+
+def compile_source(contents: str, filename: str, options: Options, graph: parse.ModuleGraph = None,
+                   with_assembly: bool = False) -> Result:
+    # the optimizer and assembler are only imported by runs that use them
+    result = Result()
+    result.report = None
+    result.assembly = None
+    tree = _profiled('ast.parse', filename, ast.parse, contents, filename)
+    if graph is None:
+        graph = parse.ModuleGraph()
+    collector = None
+    if options.max_errors is not None:
+        collector = graph.collector = errors.ErrorCollector(options.max_errors or None)
+    program = _profiled('parse', filename, _parse, tree, options, graph, collector)
+    result.consts = graph.entry.consts
+    if options.opt_level > 0:
+        from pyasm import optimize
+        result.report = optimize.Report()
+        program = _profiled('optimize', None, optimize.optimize, program, options.opt_level, result.report)
+    result.program = program
+    if options.hex and options.format == 'asm':
+        result.program = generate.hex_operands(program)
+    if options.format != 'asm' or with_assembly:
+        result.assembly = _profiled('assemble', None, _assemble, program, options.origin)
+    return result
+
+
+def _profiled(phase: str, module: Union[str, None], fn, *args):
+    # fn(*args) as a phase of the active profile; the phase ends even if fn raises
+    if (prof := instrument.ACTIVE) is None:
+        return fn(*args)
+    prof.enter(phase, module)
+    try:
+        return fn(*args)
+    finally:
+        prof.leave()
+
+
+def _parse(tree: ast.Module, options: Options, graph: parse.ModuleGraph,
+           collector: Union[errors.ErrorCollector, None]) -> objasm.Program:
+    try:
+        program = parse.parse(tree, options.library_origin, graph)
+    except errors.ErrorLimitReached:
+        raise errors.CompileErrors.create_custom(collector.errors, truncated=True) from None
+    if collector is not None and collector.errors:
+        raise errors.CompileErrors.create_custom(collector.errors)
+    return program
+
+
+def _assemble(program: objasm.Program, origin: Union[int, None]) -> 'assemble.Assembly':
+    from pyasm import assemble
+    if origin is None:
+        return assemble.assemble(program)
+    return assemble.assemble(program, origin)
+
+
+def write_result(result: Result, options: Options, fp: Union[TextIO, None] = None, path: str = None) -> None:
+    # writes to the text stream fp, or to the file at path
+    if (prof := instrument.ACTIVE) is not None:
+        prof.enter('output')
+        try:
+            return _write_result(result, options, fp, path)
+        finally:
+            prof.leave()
+    _write_result(result, options, fp, path)
+
+
+def _write_result(result: Result, options: Options, fp: Union[TextIO, None] = None, path: str = None) -> None:
+    if options.format == 'bin':
+        if path is None:
+            fp.buffer.write(result.assembly.data)
+        else:
+            with open(path, 'wb') as outfp:
+                outfp.write(result.assembly.data)
+        return
+    if path is not None:
+        with open(path, 'w') as outfp:
+            _write_result(result, options, outfp)
+    elif options.format == 'hex':
+        from pyasm import assemble
+        fp.write(assemble.to_intel_hex(result.assembly.data, result.assembly.origin))
+    else:
+        generate.write_asm(result.program, fp)
+
+
+def format_error(e: Union[errors.PyASMError, SyntaxError], filename: str, contents: str) -> str:
+    if isinstance(e, errors.CompileErrors):
+        parts = [format_error(error, filename, contents) for error in e.errors]
+        return '\n'.join(parts + [e.args[0]])
+    lineno = e.lineno
+    colno = getattr(e, 'colno', None)
+    if isinstance(e, SyntaxError):
+        colno = e.offset - 1 if e.offset else None
+        message = e.msg
+    else:
+        message = e.args[0]
+        if e.filename is not None and e.filename != filename:
+            filename = e.filename
+            try:
+                with open(filename) as fp:
+                    contents = fp.read()
+            except OSError:
+                lineno = None
+    if lineno is None:
+        lines = ['error in file ' + filename]
+    else:
+        lines = [f'error in file {filename}:{lineno}', '   ' + contents.splitlines()[lineno - 1]]
+        if colno is not None:
+            lines.append('  ' + ' ' * colno + ' ^')
+    lines.append(e.__class__.__qualname__ + ': ' + message)
+    return '\n'.join(lines)
+
+
+def error_records(e: Union[errors.PyASMError, SyntaxError], filename: str) -> list[dict]:
+    # one record per error for editors and other tools; line and column count from 1
+    if isinstance(e, errors.CompileErrors):
+        return [record for error in e.errors for record in error_records(error, filename)]
+    if isinstance(e, SyntaxError):
+        column = e.offset
+        message = e.msg
+    else:
+        column = e.colno + 1 if getattr(e, 'colno', None) is not None else None
+        message = e.args[0]
+        if e.filename is not None:
+            filename = e.filename
+    return [{
+        'file': filename,
+        'line': e.lineno,
+        'column': column,
+        'type': e.__class__.__qualname__,
+        'message': message,
+    }]
+
+
+def output_path(path: str, options: Options) -> str:
+    base = os.path.splitext(path)[0]
+    if options.output_dir is not None:
+        base = os.path.join(options.output_dir, os.path.basename(base))
+    return base + OUTPUT_EXTS[options.format]
+
+
+# modules parsed by this process, reused by every file it compiles
+_shared_modules: dict[str, parse.Module] = {}
+
+
+def compile_file(path: str, options: Options) -> tuple[str, Optional[str]]:
+    # returns the output path and, if compiling failed, the formatted error
+    contents = ''
+    try:
+        with open(path) as fp:
+            contents = fp.read()
+        result = compile_source(contents, path, options, parse.ModuleGraph(_shared_modules))
+        outpath = output_path(path, options)
+        write_result(result, options, path=outpath)
+    except (errors.PyASMError, SyntaxError) as e:
+        return path, format_error(e, path, contents)
+    except OSError as e:
+        return path, f'error in file {path}\n{e.__class__.__qualname__}: {e}'
+    return outpath, None
+
+
+def run_batch(paths: list[str], options: Options, jobs: int = 1, out: TextIO = sys.stdout,
+              mp_context: Optional['multiprocessing.context.BaseContext'] = None) -> int:
+    if options.output_dir is not None:
+        os.makedirs(options.output_dir, exist_ok=True)
+    if jobs == 1:
+        results = (compile_file(path, options) for path in paths)
+        failures = _report_batch(paths, results, out)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs, mp_context, _init_worker, (cache.ENABLED,)) as pool:
+            results = pool.map(compile_file, paths, [options] * len(paths))
+            failures = _report_batch(paths, results, out)
+    print(f'compiled {len(paths) - failures} of {len(paths)} files', file=out)
+    return failures
+
+
+def _init_worker(cache_enabled: bool) -> None:
+    # spawned and forkserver workers start from a fresh import of pyasm, so
+    # module settings made by the parent (--no-cache) are passed on here
+    cache.ENABLED = cache_enabled
+
+
+def _report_batch(paths, results, out: TextIO) -> int:
+    failures = 0
+    for (path, (outpath, error)) in zip(paths, results):
+        if error is None:
+            print(f'{path} -> {outpath}', file=out)
+        else:
+            failures += 1
+            print(error, file=out)
+    return failures
+
+
+class Watcher:
+    # Recompiles entry files whenever they or anything they import change,
+    # reusing every parsed module and function the change did not touch.
+    def __init__(self, paths: list[str], options: Options, output: str = None, out: TextIO = sys.stdout) -> None:
+        self.paths = paths
+        self.options = options
+        # only used when watching a single entry file
+        self.output = output
+        self.out = out
+        self.modules: dict[str, parse.Module] = {}
+        self.functions = parse.FunctionCache()
+        # entry file -> every file its last build read
+        self.inputs: dict[str, set[str]] = {}
+        self.stamps: dict[str, Optional[tuple[int, int]]] = {}
+
+    @staticmethod
+    def _stamp(path: str) -> Optional[tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def build(self, path: str, changed_at: int = None) -> bool:
+        start = time.perf_counter_ns()
+        hits, misses = self.functions.hits, self.functions.misses
+        graph = parse.ModuleGraph(self.modules, self.functions)
+        inputs = {os.path.abspath(path)}
+        contents = ''
+        error = None
+        try:
+            with open(path) as fp:
+                contents = fp.read()
+            result = compile_source(contents, path, self.options, graph)
+            outpath = self.output or output_path(path, self.options)
+            write_result(result, self.options, path=outpath)
+        except (errors.PyASMError, SyntaxError) as e:
+            error = format_error(e, path, contents)
+            if getattr(e, 'filename', None) is not None:
+                inputs.add(os.path.abspath(e.filename))
+        except OSError as e:
+            error = f'error in file {path}\n{e.__class__.__qualname__}: {e}'
+        done = time.perf_counter_ns()
+        inputs.update(graph.modules)
+        self.inputs[path] = inputs
+        for filepath in inputs:
+            if filepath not in self.stamps:
+                self.stamps[filepath] = self._stamp(filepath)
+        if error is not None:
+            print(error, file=self.out)
+            return False
+        reparsed = self.functions.misses - misses
+        total = reparsed + self.functions.hits - hits
+        message = f'{path} -> {outpath} in {(done - start) / 1e6:.1f} ms'
+        if changed_at is not None:
+            message += f', {(time.time_ns() - changed_at) / 1e6:.1f} ms after the change'
+        print(message + f' ({reparsed} of {total} functions parsed)', file=self.out)
+        return True
+
+    def poll(self) -> None:
+        changed = set()
+        changed_at = 0
+        for (filepath, stamp) in self.stamps.items():
+            if (new_stamp := self._stamp(filepath)) != stamp:
+                self.stamps[filepath] = new_stamp
+                changed.add(filepath)
+                if new_stamp is not None:
+                    changed_at = max(changed_at, new_stamp[0])
+        if not changed:
+            return
+        for (filepath, module) in list(self.modules.items()):
+            if filepath in changed or not changed.isdisjoint(module.deps):
+                del self.modules[filepath]
+        # a changed file may be a module that is now found somewhere else
+        parse.module_index().scan()
+        for path in self.paths:
+            if not changed.isdisjoint(self.inputs[path]):
+                self.build(path, changed_at or None)
+
+    def run(self) -> None:
+        for path in self.paths:
+            self.build(path)
+        print('watching for changes, press Ctrl+C to stop', file=self.out)
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            self.poll()
@@ -1,5 +1,7 @@
 class PyASMError(Exception):
     lineno: int
+    # set when the error comes from an imported module rather than the compiled file
+    filename: str = None
 
     @classmethod
     def create_custom(cls, message: str, **kwargs):
@@ -38,6 +40,42 @@ class UnsupportedFunctionOrElement(ParseError, ValueError):
         return super().create_custom(msg, **kwargs)
 
 
+class ConstantError(ParseError, ValueError):
+    colno: int
+
+    @classmethod
+    def create_custom(cls, message: str, el=None):
+        kwargs = {
+            'lineno': getattr(el, 'lineno', None),
+            'colno': getattr(el, 'col_offset', None),
+            'element_name': type(el).__name__
+        }
+        return super().create_custom(message, **kwargs)
+
+
+class ConstantCycleError(ConstantError):
+    cycle: list[str]
+
+    @classmethod
+    def create_custom(cls, cycle: list[str], el=None):
+        err = super().create_custom('constant defined in terms of itself: ' + ' -> '.join(cycle), el)
+        err.cycle = cycle
+        return err
+
+
+class LoopError(ParseError, ValueError):
+    colno: int
+
+    @classmethod
+    def create_custom(cls, message: str, el=None):
+        kwargs = {
+            'lineno': getattr(el, 'lineno', None),
+            'colno': getattr(el, 'col_offset', None),
+            'element_name': type(el).__name__
+        }
+        return super().create_custom(message, **kwargs)
+
+
 class NoModuleError(PyASMError, ModuleNotFoundError):
     module: str
 
@@ -45,3 +83,67 @@ class NoModuleError(PyASMError, ModuleNotFoundError):
     def create_custom(cls, module: str, lineno: int = None):
         return super().create_custom(f'unable to import module: no module named {module!r}',
                                      module=module, lineno=lineno)
+
+
+class ImportCycleError(PyASMError, ImportError):
+    cycle: list[str]
+
+    @classmethod
+    def create_custom(cls, cycle: list[str], lineno: int = None):
+        return super().create_custom('import cycle: ' + ' -> '.join(cycle), cycle=cycle, lineno=lineno)
+
+
+class AssembleError(PyASMError, ValueError):
+    label: str
+
+    @classmethod
+    def create_custom(cls, message: str, label: str = None):
+        where = f' (in {label!r})' if label is not None else ''
+        return super().create_custom(message + where, label=label, lineno=None)
+
+
+class SimulationError(PyASMError, RuntimeError):
+    address: int
+
+    @classmethod
+    def create_custom(cls, message: str, address: int = None):
+        where = f' at ${address:04x}' if address is not None else ''
+        return super().create_custom(message + where, address=address, lineno=None)
+
+
+class CompileErrors(PyASMError):
+    # everything a compile found when it was told to keep going after errors
+    errors: list[PyASMError]
+    truncated: bool
+
+    @classmethod
+    def create_custom(cls, errors: list[PyASMError], truncated: bool = False):
+        message = f'{len(errors)} error(s)' + (', stopped at the error limit' if truncated else '')
+        return super().create_custom(message, errors=errors, truncated=truncated, lineno=None)
+
+
+class ErrorLimitReached(Exception):
+    # deliberately not a PyASMError, so the parser's recovery lets it through
+    pass
+
+
+class ErrorCollector:
+    errors: list[PyASMError]
+    # None collects every error
+    limit: int
+    # the module being parsed, given to errors that do not name a file yet
+    filename: str
+
+    def __init__(self, limit: int = None) -> None:
+        self.errors = []
+        self.limit = limit
+        self.filename = None
+
+    def add(self, error: PyASMError) -> None:
+        # stops at the first error past the limit, so exactly `limit` errors
+        # are reported without claiming that any were left out
+        if self.limit is not None and len(self.errors) >= self.limit:
+            raise ErrorLimitReached()
+        if error.filename is None:
+            error.filename = self.filename
+        self.errors.append(error)
@@ -1,28 +1,102 @@
-from pyasm import objasm
+from typing import Iterator, TextIO, Union
+
+from pyasm import instrument, objasm
+
+WRITE_BATCH = 256
+
+
+# a decimal number that is not part of a label, a $hex number or a negative number
+DECIMAL_PATTERN = r'(?<![\w$-])\d+(?!\w)'
+
+
+def _hex_number(match) -> str:
+    value = int(match.group())
+    return f'${value:02x}' if value < 0x100 else f'${value:04x}'
+
+
+def hex_operands(program: objasm.Program) -> objasm.Program:
+    # the same program with every numeric operand written as $hex
+    import re
+    decimal = re.compile(DECIMAL_PATTERN)
+    labels = []
+    for label in program.labels:
+        codes = [objasm.OpCode.from_interned(op.op, [decimal.sub(_hex_number, arg) for arg in op.args])
+                 for op in label.codes]
+        labels.append(label.with_codes(codes))
+    return objasm.Program(labels=labels)
 
 
 def generate_asm_for_operator(op: objasm.OpCode) -> str:
     return ' '.join([op.op] + op.args)
 
 
+def iter_asm_for_label(label: objasm.Label, indent='\t') -> Iterator[str]:
+    if label.origin is not None:
+        yield f'{indent}.org ${label.origin:04x}\n'
+    for alias in label.aliases:
+        yield alias + ':\n'
+    yield label.name + ':\n'
+    for op in objasm.label_codes(label):
+        yield indent + generate_asm_for_operator(op) + '\n'
+
+
 def generate_asm_for_label(label: objasm.Label, indent='\t') -> str:
-    result = label.name + ':\n'
-    for op in label.codes:
-        result += indent + generate_asm_for_operator(op) + '\n'
-    return result
+    return ''.join(iter_asm_for_label(label, indent))
+
+
+def iter_packed_asm(root: objasm.PackedProgram, indent='\t') -> Iterator[str]:
+    # each distinct (mnemonic, operands) pair is formatted once
+    ops, arg_starts, arg_ids = root.ops, root.arg_starts, root.arg_ids
+    mnemonics, operands = root.mnemonics, root.operands
+    lines = {}
+    for (li, (name, start, end)) in enumerate(root.label_bounds()):
+        chunk = ['\n']
+        if (origin := root.label_origin(li)) is not None:
+            chunk.append(f'{indent}.org ${origin:04x}\n')
+        chunk += [name, ':\n']
+        if name == objasm.HALT_LABEL and start == end:
+            chunk.append(f'{indent}jmp {objasm.HALT_LABEL}\n')
+        for ix in range(start, end):
+            key = (ops[ix], *arg_ids[arg_starts[ix]:arg_starts[ix + 1]])
+            if (line := lines.get(key)) is None:
+                line = lines[key] = indent + ' '.join([mnemonics[key[0]]] + [operands[a] for a in key[1:]]) + '\n'
+            chunk.append(line)
+        chunk.append('\n')
+        yield ''.join(chunk)
+
+
+AnyProgram = Union[objasm.Program, objasm.PackedProgram]
 
 
-def generate_asm(root: objasm.Program) -> str:
-    result = ''
+def iter_asm(root: AnyProgram) -> Iterator[str]:
+    if isinstance(root, objasm.PackedProgram):
+        if (prof := instrument.ACTIVE) is not None:
+            prof.count('instructions emitted', len(root.ops))
+        yield from iter_packed_asm(root)
+        return
+    if (prof := instrument.ACTIVE) is not None:
+        prof.count('instructions emitted', sum(len(label.codes) for label in root.labels))
     for label in root.labels:
-        result += '\n'
-        result += generate_asm_for_label(label)
-        result += '\n'
-    return result
+        yield '\n' + generate_asm_for_label(label) + '\n'
+
+
+def write_asm(root: AnyProgram, fp: TextIO) -> None:
+    # one write per label is dominated by call overhead on big programs
+    batch = []
+    for chunk in iter_asm(root):
+        batch.append(chunk)
+        if len(batch) >= WRITE_BATCH:
+            fp.write(''.join(batch))
+            batch.clear()
+    fp.write(''.join(batch))
+
+
+def generate_asm(root: AnyProgram) -> str:
+    return ''.join(iter_asm(root))
 
 
 if __name__ == '__main__':
     from pyasm import parse
     import ast
     import sys
-    print(generate_asm(parse.parse(ast.parse(open(sys.argv[1]).read()))))
+    write_asm(parse.parse(ast.parse(open(sys.argv[1]).read())), sys.stdout)
@@ -0,0 +1,81 @@
+import time
+
+# The profile being recorded, or None. Instrumented code checks this before
+# doing anything else, so a run without --profile only pays for that check.
+ACTIVE: 'Profile' = None
+
+
+class Profile:
+    # Phases nest (a module load parses, which looks up imports, which load
+    # further modules); every moment is charged to the innermost phase and
+    # module only, so the phase times add up to the total.
+    phases: dict[str, float]
+    modules: dict[str, float]
+    counters: dict[str, int]
+
+    def __init__(self) -> None:
+        self.phases = {}
+        self.modules = {}
+        self.counters = {}
+        self.stack: list[tuple[str, str]] = []
+        self.mark = time.perf_counter()
+
+    def _charge(self, now: float) -> None:
+        if self.stack:
+            phase, module = self.stack[-1]
+            self.phases[phase] = self.phases.get(phase, 0.0) + now - self.mark
+            if module is not None:
+                self.modules[module] = self.modules.get(module, 0.0) + now - self.mark
+        self.mark = now
+
+    def enter(self, phase: str, module: str = None) -> None:
+        self._charge(time.perf_counter())
+        if module is None and self.stack:
+            module = self.stack[-1][1]
+        self.stack.append((phase, module))
+
+    def leave(self) -> None:
+        self._charge(time.perf_counter())
+        self.stack.pop()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+    def to_json(self) -> str:
+        import json
+        return json.dumps({
+            'total_seconds': self.total(),
+            'phases': self.phases,
+            'modules': self.modules,
+            'counters': self.counters,
+        }, indent=2)
+
+    def format(self) -> str:
+        lines = [f'{"phase":48} {"ms":>10}']
+        for (phase, seconds) in self.phases.items():
+            lines.append(f'{phase:48} {seconds * 1e3:10.2f}')
+        lines.append(f'{"total":48} {self.total() * 1e3:10.2f}')
+        if self.modules:
+            lines += ['', f'{"module":48} {"ms":>10}']
+            for (module, seconds) in sorted(self.modules.items(), key=lambda item: -item[1]):
+                lines.append(f'{module:48} {seconds * 1e3:10.2f}')
+        if self.counters:
+            lines += ['', f'{"counter":48} {"count":>10}']
+            for (name, amount) in self.counters.items():
+                lines.append(f'{name:48} {amount:10}')
+        return '\n'.join(lines)
+
+
+def start() -> Profile:
+    global ACTIVE
+    ACTIVE = Profile()
+    return ACTIVE
+
+
+def stop() -> Profile:
+    global ACTIVE
+    profile, ACTIVE = ACTIVE, None
+    return profile
@@ -1,32 +1,223 @@
 from __future__ import annotations
 
-from typing import Any, Dict
+import sys
+from array import array
+from typing import Any, Dict, Iterator, Optional
+
+
+HALT_LABEL = '___hlt___'
+
+# PackedProgram.label_origins entry of a label that follows the previous one
+NO_ORIGIN = -1
 
 
 class ASMNode:
-    def __init__(self, **kwargs) -> None:
-        self.__dict__.update(kwargs)
-    
+    __slots__ = ()
+    _fields: tuple[str, ...] = ()
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._fields = tuple(cls.__dict__.get('__annotations__', ()))
+
     def get_parts(self) -> Dict[str, Any]:
-        res = {}
-        for ann in self.__class__.__annotations__:
-            res[ann] = getattr(self, ann)
-        return res
+        return {name: getattr(self, name) for name in self._fields}
 
 
 class Program(ASMNode):
+    __slots__ = ('labels',)
     labels: list[Label]
 
+    def __init__(self, labels: list[Label]) -> None:
+        self.labels = labels
+
+    def copy(self) -> Program:
+        return Program([label.copy() for label in self.labels])
+
 
 class Label(ASMNode):
+    __slots__ = ('name', 'codes', 'reserve', 'aliases', 'origin', 'inline')
     name: str
     codes: list[OpCode]
+    # bytes of storage after the code, for reserve_label data labels
+    reserve: int
+    # other names for the same address, from empty labels merged into this one
+    aliases: list[str]
+    # fixed load address, or None to follow the previous label
+    origin: Optional[int]
+    # from @prefer_inline: the optimizer inlines calls to this label whatever its size
+    inline: bool
+
+    def __init__(self, name: str, codes: list[OpCode], reserve: int = 0,
+                 aliases: list[str] = None, origin: Optional[int] = None, inline: bool = False) -> None:
+        self.name = name
+        self.codes = codes
+        self.reserve = reserve
+        self.aliases = aliases if aliases is not None else []
+        self.origin = origin
+        self.inline = inline
+
+    def with_codes(self, codes: list[OpCode]) -> Label:
+        return Label(self.name, codes, self.reserve, self.aliases.copy(), self.origin, self.inline)
+
+    def copy(self) -> Label:
+        return self.with_codes([op.copy() for op in self.codes])
+
+    @property
+    def names(self) -> list[str]:
+        return self.aliases + [self.name]
 
 
 class OpCode(ASMNode):
+    __slots__ = ('op', 'args')
     op: str
     args: list[str]
 
+    def __init__(self, op: str, args: list[str]) -> None:
+        # mnemonics come from a handful of tables, so every instance shares one string
+        self.op = sys.intern(op) if type(op) == str else op
+        self.args = args
+
+    @classmethod
+    def from_interned(cls, op: str, args: list[str]) -> OpCode:
+        # skips interning for mnemonics that already come from an OpCode
+        new = cls.__new__(cls)
+        new.op = op
+        new.args = args
+        return new
+
+    def copy(self) -> OpCode:
+        return OpCode.from_interned(self.op, self.args.copy())
+
+
+class PackedProgram:
+    # Columnar alternative to Program for very large outputs: one array entry per
+    # instruction instead of one OpCode object, operands stored once in a table.
+    __slots__ = ('mnemonics', 'operands', 'ops', 'arg_starts', 'arg_ids', 'label_names', 'label_starts',
+                 'label_reserves', 'label_origins', '_mnemonic_ids', '_operand_ids')
+    mnemonics: list[str]
+    operands: list[str]
+    ops: array
+    arg_starts: array
+    arg_ids: array
+    label_names: list[str]
+    label_starts: array
+    label_reserves: array
+    label_origins: array
+
+    def __init__(self) -> None:
+        self.mnemonics = []
+        self.operands = []
+        self._mnemonic_ids = {}
+        self._operand_ids = {}
+        # mnemonic id of each instruction
+        self.ops = array('H')
+        # instruction i uses arg_ids[arg_starts[i]:arg_starts[i + 1]]
+        self.arg_starts = array('I', [0])
+        self.arg_ids = array('I')
+        # label i covers ops[label_starts[i]:label_starts[i + 1]]
+        self.label_names = []
+        self.label_starts = array('I')
+        # bytes of storage after label i, and its fixed address or NO_ORIGIN
+        self.label_reserves = array('I')
+        self.label_origins = array('l')
+
+    @classmethod
+    def from_program(cls, program: Program) -> PackedProgram:
+        packed = cls()
+        for label in program.labels:
+            # aliases come first and are empty, so the origin goes on the first
+            # name and the storage after the code on the last
+            names = label.names
+            for (i, name) in enumerate(names):
+                packed.add_label(name, label.reserve if i == len(names) - 1 else 0,
+                                 label.origin if i == 0 else None)
+            for op in label.codes:
+                packed.add_op(op.op, op.args)
+        return packed
+
+    def _intern_mnemonic(self, op: str) -> int:
+        if (ix := self._mnemonic_ids.get(op)) is None:
+            ix = self._mnemonic_ids[op] = len(self.mnemonics)
+            self.mnemonics.append(op)
+        return ix
+
+    def _intern_operand(self, arg: str) -> int:
+        if (ix := self._operand_ids.get(arg)) is None:
+            ix = self._operand_ids[arg] = len(self.operands)
+            self.operands.append(arg)
+        return ix
+
+    def add_label(self, name: str, reserve: int = 0, origin: Optional[int] = None) -> None:
+        self.label_names.append(name)
+        self.label_starts.append(len(self.ops))
+        self.label_reserves.append(reserve)
+        self.label_origins.append(NO_ORIGIN if origin is None else origin)
+
+    def add_op(self, op: str, args: list[str]) -> None:
+        self.ops.append(self._intern_mnemonic(op))
+        self.arg_ids.extend(self._intern_operand(arg) for arg in args)
+        self.arg_starts.append(len(self.arg_ids))
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    def op_at(self, ix: int) -> OpCode:
+        operands = self.operands
+        args = [operands[a] for a in self.arg_ids[self.arg_starts[ix]:self.arg_starts[ix + 1]]]
+        return OpCode(self.mnemonics[self.ops[ix]], args)
+
+    def __iter__(self) -> Iterator[OpCode]:
+        for ix in range(len(self.ops)):
+            yield self.op_at(ix)
+
+    def label_bounds(self) -> Iterator[tuple[str, int, int]]:
+        ends = self.label_starts[1:].tolist() + [len(self.ops)]
+        return zip(self.label_names, self.label_starts, ends)
+
+    def label_origin(self, li: int) -> Optional[int]:
+        origin = self.label_origins[li]
+        return None if origin == NO_ORIGIN else origin
+
+    @property
+    def labels(self) -> list[Label]:
+        return [Label(name, [self.op_at(ix) for ix in range(start, end)], self.label_reserves[li],
+                      origin=self.label_origin(li))
+                for (li, (name, start, end)) in enumerate(self.label_bounds())]
+
+    def to_program(self) -> Program:
+        return Program(self.labels)
+
+
+def label_codes(label: Label) -> list[OpCode]:
+    # The halt label is empty in the IR, so the optimizer sees it as a
+    # stopping point; every output spins there in place, or a program that
+    # halts would run into the library code laid out after it.
+    if label.name == HALT_LABEL and not label.codes:
+        return [OpCode(op='jmp', args=[HALT_LABEL])]
+    return label.codes
+
+
+def merge_empty_labels(labels: list[Label]) -> list[Label]:
+    # An empty label shares its address with the label after it, so it becomes
+    # an alias of that label. The halt label stays separate: it is a stopping
+    # point, not a way into the code that follows it.
+    result = []
+    pending = []
+    for label in labels:
+        if pending and label.origin is not None:
+            result.extend(Label(name, []) for name in pending)
+            pending = []
+        if not (label.codes or label.reserve) and label.origin is None and label.name != HALT_LABEL:
+            pending.extend(label.names)
+            continue
+        if pending:
+            label = label.with_codes(label.codes)
+            label.aliases[:0] = pending
+            pending = []
+        result.append(label)
+    result.extend(Label(name, []) for name in pending)
+    return result
+
 
 def _dump_single(obj) -> str:
     substr = ''
@@ -44,7 +235,7 @@ def _dump_single(obj) -> str:
 
 def dump(obj: ASMNode):
     result = type(obj).__name__ + '('
-    for subname in type(obj).__annotations__:
+    for subname in obj._fields:
         subobj = getattr(obj, subname)
         substr = _dump_single(subobj)
         subresult = subname + '=' + substr + ', '
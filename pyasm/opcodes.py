@@ -0,0 +1,138 @@
+from typing import Union
+
+# Official 6502 instruction set: mnemonic -> addressing mode -> (opcode, base cycles).
+#   imp  implied          acc  accumulator      imm  #value
+#   zp   zero page        zpx  zero page,X      zpy  zero page,Y
+#   abs  absolute         abx  absolute,X       aby  absolute,Y
+#   ind  (absolute)       izx  (zero page,X)    izy  (zero page),Y
+#   rel  relative branch
+OPCODES = {
+    'adc': {'imm': (0x69, 2), 'zp': (0x65, 3), 'zpx': (0x75, 4), 'abs': (0x6d, 4),
+            'abx': (0x7d, 4), 'aby': (0x79, 4), 'izx': (0x61, 6), 'izy': (0x71, 5)},
+    'and': {'imm': (0x29, 2), 'zp': (0x25, 3), 'zpx': (0x35, 4), 'abs': (0x2d, 4),
+            'abx': (0x3d, 4), 'aby': (0x39, 4), 'izx': (0x21, 6), 'izy': (0x31, 5)},
+    'asl': {'acc': (0x0a, 2), 'zp': (0x06, 5), 'zpx': (0x16, 6), 'abs': (0x0e, 6), 'abx': (0x1e, 7)},
+    'bcc': {'rel': (0x90, 2)},
+    'bcs': {'rel': (0xb0, 2)},
+    'beq': {'rel': (0xf0, 2)},
+    'bit': {'zp': (0x24, 3), 'abs': (0x2c, 4)},
+    'bmi': {'rel': (0x30, 2)},
+    'bne': {'rel': (0xd0, 2)},
+    'bpl': {'rel': (0x10, 2)},
+    'brk': {'imp': (0x00, 7)},
+    'bvc': {'rel': (0x50, 2)},
+    'bvs': {'rel': (0x70, 2)},
+    'clc': {'imp': (0x18, 2)},
+    'cld': {'imp': (0xd8, 2)},
+    'cli': {'imp': (0x58, 2)},
+    'clv': {'imp': (0xb8, 2)},
+    'cmp': {'imm': (0xc9, 2), 'zp': (0xc5, 3), 'zpx': (0xd5, 4), 'abs': (0xcd, 4),
+            'abx': (0xdd, 4), 'aby': (0xd9, 4), 'izx': (0xc1, 6), 'izy': (0xd1, 5)},
+    'cpx': {'imm': (0xe0, 2), 'zp': (0xe4, 3), 'abs': (0xec, 4)},
+    'cpy': {'imm': (0xc0, 2), 'zp': (0xc4, 3), 'abs': (0xcc, 4)},
+    'dec': {'zp': (0xc6, 5), 'zpx': (0xd6, 6), 'abs': (0xce, 6), 'abx': (0xde, 7)},
+    'dex': {'imp': (0xca, 2)},
+    'dey': {'imp': (0x88, 2)},
+    'eor': {'imm': (0x49, 2), 'zp': (0x45, 3), 'zpx': (0x55, 4), 'abs': (0x4d, 4),
+            'abx': (0x5d, 4), 'aby': (0x59, 4), 'izx': (0x41, 6), 'izy': (0x51, 5)},
+    'inc': {'zp': (0xe6, 5), 'zpx': (0xf6, 6), 'abs': (0xee, 6), 'abx': (0xfe, 7)},
+    'inx': {'imp': (0xe8, 2)},
+    'iny': {'imp': (0xc8, 2)},
+    'jmp': {'abs': (0x4c, 3), 'ind': (0x6c, 5)},
+    'jsr': {'abs': (0x20, 6)},
+    'lda': {'imm': (0xa9, 2), 'zp': (0xa5, 3), 'zpx': (0xb5, 4), 'abs': (0xad, 4),
+            'abx': (0xbd, 4), 'aby': (0xb9, 4), 'izx': (0xa1, 6), 'izy': (0xb1, 5)},
+    'ldx': {'imm': (0xa2, 2), 'zp': (0xa6, 3), 'zpy': (0xb6, 4), 'abs': (0xae, 4), 'aby': (0xbe, 4)},
+    'ldy': {'imm': (0xa0, 2), 'zp': (0xa4, 3), 'zpx': (0xb4, 4), 'abs': (0xac, 4), 'abx': (0xbc, 4)},
+    'lsr': {'acc': (0x4a, 2), 'zp': (0x46, 5), 'zpx': (0x56, 6), 'abs': (0x4e, 6), 'abx': (0x5e, 7)},
+    'nop': {'imp': (0xea, 2)},
+    'ora': {'imm': (0x09, 2), 'zp': (0x05, 3), 'zpx': (0x15, 4), 'abs': (0x0d, 4),
+            'abx': (0x1d, 4), 'aby': (0x19, 4), 'izx': (0x01, 6), 'izy': (0x11, 5)},
+    'pha': {'imp': (0x48, 3)},
+    'php': {'imp': (0x08, 3)},
+    'pla': {'imp': (0x68, 4)},
+    'plp': {'imp': (0x28, 4)},
+    'rol': {'acc': (0x2a, 2), 'zp': (0x26, 5), 'zpx': (0x36, 6), 'abs': (0x2e, 6), 'abx': (0x3e, 7)},
+    'ror': {'acc': (0x6a, 2), 'zp': (0x66, 5), 'zpx': (0x76, 6), 'abs': (0x6e, 6), 'abx': (0x7e, 7)},
+    'rti': {'imp': (0x40, 6)},
+    'rts': {'imp': (0x60, 6)},
+    'sbc': {'imm': (0xe9, 2), 'zp': (0xe5, 3), 'zpx': (0xf5, 4), 'abs': (0xed, 4),
+            'abx': (0xfd, 4), 'aby': (0xf9, 4), 'izx': (0xe1, 6), 'izy': (0xf1, 5)},
+    'sec': {'imp': (0x38, 2)},
+    'sed': {'imp': (0xf8, 2)},
+    'sei': {'imp': (0x78, 2)},
+    'sta': {'zp': (0x85, 3), 'zpx': (0x95, 4), 'abs': (0x8d, 4), 'abx': (0x9d, 5),
+            'aby': (0x99, 5), 'izx': (0x81, 6), 'izy': (0x91, 6)},
+    'stx': {'zp': (0x86, 3), 'zpy': (0x96, 4), 'abs': (0x8e, 4)},
+    'sty': {'zp': (0x84, 3), 'zpx': (0x94, 4), 'abs': (0x8c, 4)},
+    'tax': {'imp': (0xaa, 2)},
+    'tay': {'imp': (0xa8, 2)},
+    'tsx': {'imp': (0xba, 2)},
+    'txa': {'imp': (0x8a, 2)},
+    'txs': {'imp': (0x9a, 2)},
+    'tya': {'imp': (0x98, 2)},
+}
+
+MODE_SIZES = {
+    'imp': 1, 'acc': 1,
+    'imm': 2, 'zp': 2, 'zpx': 2, 'zpy': 2, 'izx': 2, 'izy': 2, 'rel': 2,
+    'abs': 3, 'abx': 3, 'aby': 3, 'ind': 3,
+}
+
+# absolute modes and the zero-page mode used instead when the address fits in a byte
+ZERO_PAGE_FORMS = {'abs': 'zp', 'abx': 'zpx', 'aby': 'zpy'}
+
+# these read instructions take an extra cycle when indexing crosses a page
+PAGE_PENALTY = {'adc', 'and', 'cmp', 'eor', 'lda', 'ldx', 'ldy', 'ora', 'sbc'}
+
+BRANCHES = {name for (name, modes) in OPCODES.items() if 'rel' in modes}
+
+# opcode byte -> (mnemonic, mode, base cycles)
+DECODE = {opcode: (name, mode, cycles)
+          for (name, modes) in OPCODES.items()
+          for (mode, (opcode, cycles)) in modes.items()}
+
+Operand = Union[int, str, None]
+
+
+def parse_value(text: str) -> Operand:
+    if text.startswith('$'):
+        return int(text[1:], 16)
+    try:
+        return int(text, 0)
+    except ValueError:
+        return text
+
+
+def parse_operand(op: str, args: list[str]) -> tuple[str, Operand]:
+    # returns the addressing mode and either a number or a label name
+    modes = OPCODES[op]
+    if not args:
+        return ('imp' if 'imp' in modes else 'acc'), None
+    arg = args[0].strip()
+    if arg.lower() == 'a' and 'acc' in modes:
+        return 'acc', None
+    if arg.startswith('#'):
+        return 'imm', parse_value(arg[1:])
+    if 'rel' in modes:
+        return 'rel', parse_value(arg)
+    if arg.startswith('(') and arg.endswith(')'):
+        return 'ind', parse_value(arg[1:-1])
+    if ',' in arg:
+        base, _, index = arg.partition(',')
+        mode, value = ('abx' if index.strip().lower() == 'x' else 'aby'), parse_value(base.strip())
+    else:
+        mode, value = 'abs', parse_value(arg)
+    # an address below $100 gets the shorter, faster zero-page form
+    if type(value) == int and 0 <= value <= 0xff and ZERO_PAGE_FORMS[mode] in modes:
+        mode = ZERO_PAGE_FORMS[mode]
+    return mode, value
+
+
+def instruction_size(op: str, args: list[str]) -> int:
+    return MODE_SIZES[parse_operand(op, args)[0]]
+
+
+def instruction_cycles(op: str, args: list[str]) -> int:
+    mode, _ = parse_operand(op, args)
+    return OPCODES[op][mode][1]
@@ -0,0 +1,576 @@
+from typing import Callable, Union
+
+from pyasm import objasm, opcodes
+
+MAX_ROUNDS = 64
+
+LOAD_IMMEDIATE = {'lda', 'ldx', 'ldy'}
+
+# instructions after which execution never reaches the next label
+NO_FALL_THROUGH = {'jmp', 'rts', 'rti', 'brk'}
+
+
+class RuleStats:
+    applied: int
+    bytes: int
+    cycles: int
+
+    def __init__(self) -> None:
+        self.applied = 0
+        self.bytes = 0
+        self.cycles = 0
+
+
+class Report:
+    def __init__(self) -> None:
+        self.rules: dict[str, RuleStats] = {}
+        self.removed_labels: list[str] = []
+
+    def record(self, name: str, removed: list[objasm.OpCode], added: list[objasm.OpCode]) -> None:
+        stats = self.rules.setdefault(name, RuleStats())
+        stats.applied += 1
+        stats.bytes += code_size(removed) - code_size(added)
+        stats.cycles += code_cycles(removed) - code_cycles(added)
+
+    def format(self) -> str:
+        lines = [f'{"optimization":28} {"applied":>8} {"bytes":>8} {"cycles":>8}']
+        for (name, stats) in self.rules.items():
+            lines.append(f'{name:28} {stats.applied:8} {stats.bytes:8} {stats.cycles:8}')
+        if self.removed_labels:
+            lines.append('removed unreachable labels: ' + ', '.join(self.removed_labels))
+        return '\n'.join(lines)
+
+
+def code_size(codes: list[objasm.OpCode]) -> int:
+    return sum(opcodes.instruction_size(op.op, op.args) for op in codes if op.op in opcodes.OPCODES)
+
+
+def code_cycles(codes: list[objasm.OpCode]) -> int:
+    # static cost: every instruction executed once, branches not taken
+    return sum(opcodes.instruction_cycles(op.op, op.args) for op in codes if op.op in opcodes.OPCODES)
+
+
+# A peephole rule looks at codes[ix:] and either returns None or the number of
+# instructions it consumed together with their replacement. `following` holds
+# every label that execution falls into from the end of the current label.
+PeepholeRule = Callable[[list[objasm.OpCode], int, set[str]], Union[tuple[int, list[objasm.OpCode]], None]]
+
+RULES: dict[str, tuple[int, PeepholeRule]] = {}
+
+
+def peephole_rule(name: str, level: int = 1) -> Callable[[PeepholeRule], PeepholeRule]:
+    def decorator(rule: PeepholeRule) -> PeepholeRule:
+        RULES[name] = (level, rule)
+        return rule
+    return decorator
+
+
+@peephole_rule('jump-to-next-label')
+def _jump_to_next_label(codes, ix, following):
+    op = codes[ix]
+    if op.op == 'jmp' and ix == len(codes) - 1 and op.args and op.args[0] in following:
+        return 1, []
+
+
+@peephole_rule('tail-call')
+def _tail_call(codes, ix, following):
+    if codes[ix].op == 'jsr' and ix + 1 < len(codes) and codes[ix + 1].op == 'rts':
+        return 2, [objasm.OpCode(op='jmp', args=codes[ix].args.copy())]
+
+
+@peephole_rule('remove-nop')
+def _remove_nop(codes, ix, following):
+    if codes[ix].op == 'nop':
+        return 1, []
+
+
+@peephole_rule('overwritten-load-immediate')
+def _overwritten_load_immediate(codes, ix, following):
+    # the second load replaces both the register and the N/Z flags set by the first
+    op = codes[ix]
+    if op.op in LOAD_IMMEDIATE and ix + 1 < len(codes):
+        nextop = codes[ix + 1]
+        if nextop.op == op.op and op.args[:1] and op.args[0].startswith('#') \
+                and nextop.args[:1] and nextop.args[0].startswith('#'):
+            return 1, []
+
+
+def _fall_through_names(labels: list[objasm.Label], li: int) -> set[str]:
+    names = set()
+    for label in labels[li + 1:]:
+        # execution stops at the halt label, it never reaches the code after it
+        if label.origin is not None or label.name == objasm.HALT_LABEL:
+            if label.origin is None:
+                names.add(label.name)
+            break
+        names.update(label.names)
+        if label.codes or label.reserve:
+            break
+    return names
+
+
+def peephole(program: objasm.Program, level: int = 1, report: Report = None) -> objasm.Program:
+    if report is None:
+        report = Report()
+    rules = [(name, rule) for (name, (rule_level, rule)) in RULES.items() if rule_level <= level]
+    labels = program.labels
+    for _ in range(MAX_ROUNDS):
+        changed = False
+        new_labels = []
+        for (li, label) in enumerate(labels):
+            following = _fall_through_names(labels, li)
+            codes = label.codes
+            out = []
+            ix = 0
+            while ix < len(codes):
+                for (name, rule) in rules:
+                    if (match := rule(codes, ix, following)) is not None:
+                        consumed, replacement = match
+                        report.record(name, codes[ix:ix + consumed], replacement)
+                        out.extend(replacement)
+                        ix += consumed
+                        changed = True
+                        break
+                else:
+                    out.append(codes[ix])
+                    ix += 1
+            if len(out) == len(codes) and all(a is b for (a, b) in zip(out, codes)):
+                new_labels.append(label)
+            else:
+                new_labels.append(label.with_codes(out))
+        labels = new_labels
+        if not changed:
+            break
+    return objasm.Program(labels=labels)
+
+
+def label_references(op: objasm.OpCode) -> list[str]:
+    if op.op not in opcodes.OPCODES:
+        return [arg for arg in op.args if arg.isidentifier()]
+    _, value = opcodes.parse_operand(op.op, op.args)
+    return [value] if type(value) == str else []
+
+
+def _with_origin(label: objasm.Label, origin: int) -> objasm.Label:
+    # a removed label's fixed address (from --library-origin) goes to the label
+    # that now comes first, so the code after it still lands there
+    if label.origin is not None:
+        return label
+    label = label.with_codes(label.codes)
+    label.origin = origin
+    return label
+
+
+def eliminate_dead_code(program: objasm.Program, level: int = 1, report: Report = None) -> objasm.Program:
+    # Reachability from the entry label, following label operands (jumps, calls,
+    # branches and data references alike) and fall-through into the next label.
+    if report is None:
+        report = Report()
+    labels = program.labels
+    if not labels:
+        return program
+    index = {name: li for (li, label) in enumerate(labels) for name in label.names}
+    reachable = set()
+    pending = [0]
+    while pending:
+        li = pending.pop()
+        if li in reachable:
+            continue
+        reachable.add(li)
+        label = labels[li]
+        for op in label.codes:
+            if op.op == 'jmp' and opcodes.parse_operand(op.op, op.args)[0] == 'ind':
+                # the target is only known at run time
+                return program
+            for ref in label_references(op):
+                if (target := index.get(ref)) is not None:
+                    pending.append(target)
+        # execution stops at the halt label and never runs reserved storage
+        if label.name == objasm.HALT_LABEL or label.reserve:
+            continue
+        if li + 1 < len(labels) and not (label.codes and label.codes[-1].op in NO_FALL_THROUGH):
+            pending.append(li + 1)
+    if len(reachable) == len(labels):
+        return program
+    kept = []
+    removed = []
+    origin = None
+    for (li, label) in enumerate(labels):
+        if li in reachable:
+            if origin is not None:
+                label = _with_origin(label, origin)
+                origin = None
+            kept.append(label)
+        else:
+            if label.origin is not None:
+                origin = label.origin
+            removed.append(label)
+            report.removed_labels.extend(label.names)
+    report.record('dead-code', [op for label in removed for op in label.codes], [])
+    report.rules['dead-code'].bytes += sum(label.reserve for label in removed)
+    return objasm.Program(labels=kept)
+
+
+def merge_labels(program: objasm.Program, level: int = 1, report: Report = None) -> objasm.Program:
+    # earlier passes can leave labels with no code behind
+    return objasm.Program(labels=objasm.merge_empty_labels(program.labels))
+
+
+# Subroutines whose body (without the rts) is at most this many bytes are
+# inlined without a @prefer_inline hint; a jsr is 3 bytes, so these barely grow.
+INLINE_MAX_BYTES = 6
+# how many bytes inlining may add to the whole program
+INLINE_BUDGET = 256
+
+# instructions that depend on being called with jsr
+NOT_INLINABLE = {'jsr', 'rts', 'rti', 'brk', 'tsx', 'txs'}
+
+
+def _inline_body(labels: list[objasm.Label], li: int,
+                 referrers: dict[str, set[int]]) -> Union[list[objasm.Label], None]:
+    # The labels from labels[li] up to the first rts, if they form a leaf
+    # subroutine that can be copied into a caller: one rts at the very end, no
+    # calls, and every branch and jump staying inside.
+    extent = []
+    for label in labels[li:]:
+        if label.reserve or extent and label.origin is not None or label.name == objasm.HALT_LABEL:
+            return None
+        extent.append(label)
+        if label.codes and label.codes[-1].op in NO_FALL_THROUGH:
+            break
+    else:
+        return None
+    if extent[-1].codes[-1].op != 'rts':
+        return None
+    names = {name for label in extent for name in label.names}
+    indices = range(li, li + len(extent))
+    for name in names - set(extent[0].names):
+        if not referrers.get(name, set()) <= set(indices):
+            return None
+    for label in extent:
+        for (ix, op) in enumerate(label.codes):
+            if op.op not in opcodes.OPCODES or op.op in NOT_INLINABLE and op is not extent[-1].codes[-1]:
+                return None
+            mode, value = opcodes.parse_operand(op.op, op.args)
+            if op.op == 'jmp' and mode == 'ind':
+                return None
+            if (op.op == 'jmp' or mode == 'rel') and value not in names:
+                return None
+            # references to the subroutine's own labels are renamed in each copy
+            if any(ref in names and ref not in op.args for ref in label_references(op)):
+                return None
+    return extent
+
+
+def _layout(labels: list[objasm.Label]) -> tuple[dict[str, int], dict[int, int], list[tuple[int, str]]]:
+    # Estimated address of every label name and instruction (by id), and every
+    # relative branch as (address after it, target). Zero-page operands only
+    # make code shorter, so real distances are at most these.
+    label_at = {}
+    op_at = {}
+    branches = []
+    pc = 0
+    for label in labels:
+        if label.origin is not None:
+            pc = label.origin
+        for name in label.names:
+            label_at[name] = pc
+        for op in objasm.label_codes(label):
+            op_at[id(op)] = pc
+            if op.op in opcodes.OPCODES:
+                mode, value = opcodes.parse_operand(op.op, op.args)
+                pc += opcodes.MODE_SIZES[mode]
+                if mode == 'rel' and type(value) == str:
+                    branches.append((pc, value))
+        pc += label.reserve
+    return label_at, op_at, branches
+
+
+def _branches_fit(label_at: dict[str, int], branches: list[tuple[int, str]],
+                  inserted: list[tuple[int, int]]) -> bool:
+    # whether every branch that reaches its target still does once the code
+    # at each inserted (address, bytes) grows by that many bytes
+    def moved(address: int) -> int:
+        return address + sum(grow for (at, grow) in inserted if address > at)
+    for (end, target) in branches:
+        if (address := label_at.get(target)) is None:
+            continue
+        if -128 <= address - end <= 127 and not -128 <= moved(address) - moved(end) <= 127:
+            return False
+    return True
+
+
+def _referrers(labels: list[objasm.Label]) -> dict[str, set[int]]:
+    referrers = {}
+    for (li, label) in enumerate(labels):
+        for op in label.codes:
+            for ref in label_references(op):
+                referrers.setdefault(ref, set()).add(li)
+    return referrers
+
+
+def inline_subroutines(program: objasm.Program, level: int = 1, report: Report = None) -> objasm.Program:
+    # Copies small leaf subroutines, and ones marked @prefer_inline, into every
+    # jsr that calls them, working up the call graph: a subroutine whose calls
+    # were all inlined can be inlined into its own callers next. A subroutine
+    # that is no longer referenced afterwards is dropped.
+    if report is None:
+        report = Report()
+    labels = program.labels
+    used_names = {name for label in labels for name in label.names}
+    growth = 0
+    done = set()
+    copies = 0
+    while True:
+        referrers = _referrers(labels)
+        label_at, op_at, branches = _layout(labels)
+        inserted = []
+        for (li, label) in enumerate(labels):
+            if label.name in done or label.name not in referrers:
+                continue
+            if (extent := _inline_body(labels, li, referrers)) is None:
+                continue
+            body = [op for part in extent for op in part.codes][:-1]
+            size = code_size(body)
+            if label.inline or size <= INLINE_MAX_BYTES:
+                break
+        else:
+            break
+        done.add(label.name)
+        entry_names = set(label.names)
+        names = {name for part in extent for name in part.names}
+        # a single label that does not branch to itself can be spliced in as is
+        splice = len(extent) == 1 and not any(ref in names for op in body for ref in label_references(op))
+        new_labels = []
+        for (ci, caller) in enumerate(labels):
+            if li <= ci < li + len(extent) or caller.reserve:
+                new_labels.append(caller)
+                continue
+            part = caller
+            codes = []
+            changed = False
+            for op in caller.codes:
+                grow = size - code_size([op])
+                # inlining must not push a branch around the call out of reach
+                if not (op.op == 'jsr' and op.args and op.args[0] in entry_names
+                        and growth + grow <= INLINE_BUDGET
+                        and _branches_fit(label_at, branches, inserted + [(op_at[id(op)], grow)])):
+                    codes.append(op)
+                    continue
+                changed = True
+                growth += grow
+                inserted.append((op_at[id(op)], grow))
+                report.record('inline', [op, extent[-1].codes[-1]], [])
+                report.rules['inline'].bytes -= size
+                if splice:
+                    codes.extend(inlined.copy() for inlined in body)
+                    continue
+                copies += 1
+                while any(f'{name}_inline{copies}' in used_names for name in names):
+                    copies += 1
+                renames = {name: f'{name}_inline{copies}' for name in names}
+                used_names.update(renames.values())
+                new_labels.append(part.with_codes(codes))
+                for original in extent:
+                    codes = [objasm.OpCode.from_interned(inlined.op, [renames.get(arg, arg) for arg in inlined.args])
+                             for inlined in original.codes]
+                    part = objasm.Label(renames[original.name], codes,
+                                        aliases=[renames[alias] for alias in original.aliases])
+                    if original is not extent[-1]:
+                        new_labels.append(part)
+                # drop the rts; the caller's remaining code continues in the last copied label
+                codes.pop()
+            new_labels.append(part.with_codes(codes) if changed else caller)
+        labels = new_labels
+        # drop the original once nothing refers to it and nothing falls into it
+        start = next(i for (i, part) in enumerate(labels) if part is extent[0])
+        previous = labels[start - 1] if start else None
+        falls_in = previous is None or not (previous.reserve or previous.name == objasm.HALT_LABEL
+                                            or previous.codes and previous.codes[-1].op in NO_FALL_THROUGH)
+        outside = labels[:start] + labels[start + len(extent):]
+        if not falls_in and not any(ref in names for part in outside for op in part.codes
+                                    for ref in label_references(op)):
+            if extent[0].origin is not None and start < len(outside):
+                outside[start] = _with_origin(outside[start], extent[0].origin)
+            labels = outside
+            report.rules['inline'].bytes += size + code_size([extent[-1].codes[-1]])
+            report.removed_labels.extend(name for part in extent for name in part.names)
+    return objasm.Program(labels=labels)
+
+
+# Register contents for eliminate_redundant_loads: a number or '#name' for an
+# immediate operand, or a RegisterValue for a value only known to be the same
+# wherever the same RegisterValue turns up.
+class RegisterValue:
+    __slots__ = ()
+
+
+REGISTER_LOADS = {'lda': 'a', 'ldx': 'x', 'ldy': 'y'}
+REGISTER_STORES = {'sta': 'a', 'stx': 'x', 'sty': 'y'}
+TRANSFERS = {'tax': ('a', 'x'), 'tay': ('a', 'y'), 'txa': ('x', 'a'), 'tya': ('y', 'a')}
+# the transfer that puts a register's value into another register
+TRANSFER_OPS = {(source, dest): op for (op, (source, dest)) in TRANSFERS.items()}
+
+# other instructions that change a register, and set N and Z from its new value
+REGISTER_WRITES = {
+    'adc': 'a', 'sbc': 'a', 'and': 'a', 'ora': 'a', 'eor': 'a', 'pla': 'a',
+    'inx': 'x', 'dex': 'x', 'tsx': 'x',
+    'iny': 'y', 'dey': 'y',
+}
+SHIFTS = {'asl', 'lsr', 'rol', 'ror'}
+# instructions that read N or Z
+FLAG_READS = {'beq', 'bne', 'bmi', 'bpl', 'php'}
+# instructions that set N and Z (or every flag)
+FLAG_WRITES = (REGISTER_LOADS.keys() | TRANSFERS.keys() | REGISTER_WRITES.keys() | SHIFTS
+               | {'inc', 'dec', 'cmp', 'cpx', 'cpy', 'bit', 'plp'})
+# instructions after which the flags may be read somewhere else
+LEAVES_LABEL = {'jmp', 'jsr', 'rts', 'rti', 'brk', 'bcc', 'bcs', 'bvc', 'bvs'}
+
+
+class MachineState:
+    # what is known while stepping through a label; `memory` only holds values
+    # the code itself stored to a label or reserve_label, storage the program
+    # owns. A numeric address may be an I/O register, where a load need not
+    # return what was stored and a repeated store is a side effect of its own.
+    regs: dict[str, object]
+    memory: dict[str, object]
+    flags: object
+
+    def __init__(self) -> None:
+        self.regs = {'a': RegisterValue(), 'x': RegisterValue(), 'y': RegisterValue()}
+        self.memory = {}
+        self.flags = None
+
+    def copy(self) -> 'MachineState':
+        state = MachineState()
+        state.regs = self.regs.copy()
+        state.memory = self.memory.copy()
+        state.flags = self.flags
+        return state
+
+    def write_memory(self, address: Union[int, str, None], value: object = None) -> None:
+        # a label can have any numeric address, and two label names can be
+        # aliases, so a store may overwrite whatever else is known
+        self.memory = {}
+        if type(address) == str and value is not None:
+            self.memory[address] = value
+
+
+def _flags_live(codes: list[objasm.OpCode]) -> list[bool]:
+    # per instruction: whether N and Z may be read before they are set again after it
+    live = [True] * len(codes)
+    after = True
+    for ix in range(len(codes) - 1, -1, -1):
+        live[ix] = after
+        op = codes[ix].op
+        if op in FLAG_READS or op in LEAVES_LABEL or op not in opcodes.OPCODES:
+            after = True
+        elif op in FLAG_WRITES:
+            after = False
+    return live
+
+
+def _redundant_loads(codes: list[objasm.OpCode], state: MachineState,
+                     report: Report) -> tuple[list[objasm.OpCode], MachineState]:
+    out = []
+    live = _flags_live(codes)
+    regs = state.regs
+    for (ix, op) in enumerate(codes):
+        if op.op not in opcodes.OPCODES:
+            out.append(op)
+            state = MachineState()
+            regs = state.regs
+            continue
+        mode, value = opcodes.parse_operand(op.op, op.args)
+        direct = mode in ('abs', 'zp')
+        if (reg := REGISTER_LOADS.get(op.op)) is not None:
+            if mode == 'imm':
+                loaded = value
+            elif direct and value in state.memory:
+                loaded = state.memory[value]
+            else:
+                loaded = RegisterValue()
+            if regs[reg] == loaded and (state.flags == loaded or not live[ix]):
+                report.record('redundant-load', [op], [])
+                continue
+            source = next((other for other in ('a', 'x', 'y') if other != reg and regs[other] == loaded
+                           and (other, reg) in TRANSFER_OPS), None)
+            if source is not None:
+                transfer = objasm.OpCode(op=TRANSFER_OPS[source, reg], args=[])
+                if code_size([transfer]) < code_size([op]) or code_cycles([transfer]) < code_cycles([op]):
+                    report.record('load-to-transfer', [op], [transfer])
+                    op = transfer
+            regs[reg] = state.flags = loaded
+        elif (reg := REGISTER_STORES.get(op.op)) is not None:
+            if direct and state.memory.get(value) == regs[reg]:
+                report.record('redundant-store', [op], [])
+                continue
+            state.write_memory(value if direct else None, regs[reg])
+        elif (pair := TRANSFERS.get(op.op)) is not None:
+            source, dest = pair
+            if regs[dest] == regs[source] and (state.flags == regs[source] or not live[ix]):
+                report.record('redundant-load', [op], [])
+                continue
+            regs[dest] = state.flags = regs[source]
+        elif (reg := REGISTER_WRITES.get(op.op)) is not None:
+            regs[reg] = state.flags = RegisterValue()
+        elif op.op in SHIFTS and mode == 'acc':
+            regs['a'] = state.flags = RegisterValue()
+        elif op.op == 'jsr':
+            # the subroutine may change anything
+            state = MachineState()
+            regs = state.regs
+        elif op.op in ('pha', 'php'):
+            # pushing writes to the stack page
+            state.write_memory(None)
+        elif op.op == 'plp':
+            state.flags = None
+        elif op.op in FLAG_WRITES:
+            # compares, bit tests and read-modify-write memory instructions
+            state.flags = None
+            if mode not in ('imm', 'imp', 'acc') and op.op not in ('cmp', 'cpx', 'cpy', 'bit'):
+                state.write_memory(value if direct else None)
+        out.append(op)
+    return out, state
+
+
+def eliminate_redundant_loads(program: objasm.Program, level: int = 1, report: Report = None) -> objasm.Program:
+    # Tracks what A, X, Y, the N/Z flags and stored-to memory hold through each
+    # label, and drops loads and stores that would not change anything. A label
+    # starts with nothing known unless execution can only reach it by falling
+    # through from the label before. Only labels are assumed to behave like
+    # RAM: a store of the value already stored there is dropped. Numeric
+    # addresses are left alone, as they may be I/O registers.
+    if report is None:
+        report = Report()
+    referenced = {ref for label in program.labels for op in label.codes for ref in label_references(op)}
+    labels = []
+    state = MachineState()
+    for label in program.labels:
+        if any(name in referenced for name in label.names) or label.origin is not None:
+            state = MachineState()
+        codes, state = _redundant_loads(label.codes, state.copy(), report)
+        labels.append(label if len(codes) == len(label.codes) and all(a is b for (a, b) in zip(codes, label.codes))
+                      else label.with_codes(codes))
+        if label.reserve or label.codes and label.codes[-1].op in NO_FALL_THROUGH:
+            state = MachineState()
+    return objasm.Program(labels=labels)
+
+
+# optimization level -> passes enabled from that level up
+PASSES: list[tuple[int, Callable[[objasm.Program, int, Report], objasm.Program]]] = [
+    (2, inline_subroutines),
+    (1, eliminate_dead_code),
+    (1, peephole),
+    (2, eliminate_redundant_loads),
+    (1, merge_labels),
+]
+
+
+def optimize(program: objasm.Program, level: int = 1, report: Report = None) -> objasm.Program:
+    if report is None:
+        report = Report()
+    for (pass_level, opt_pass) in PASSES:
+        if pass_level <= level:
+            program = opt_pass(program, level, report)
+    return program
@@ -1,21 +1,36 @@
 import ast
+import operator
 import os
 import sys
-import glob
-from typing import Union
+from typing import Callable, Union
 
-from pyasm import errors, objasm
+from pyasm import cache, errors, instrument, objasm, opcodes
 
 fns = {
     'jump': 'jmp',
     'call': 'jsr',
     'add_memory': 'adc',
     'increment_memory': 'inc',
+    'decrement_memory': 'dec',
+    'shift_left_memory': 'asl',
+    'shift_right_memory': 'lsr',
+    'rotate_left_memory': 'rol',
+    'rotate_right_memory': 'ror',
+
+    # these work on the accumulator
+    'shift_left': 'asl',
+    'shift_right': 'lsr',
+    'rotate_left': 'rol',
+    'rotate_right': 'ror',
+    'clear_carry': 'clc',
+    'set_carry': 'sec',
 
     'branch_plus': 'bpl',
     'branch_minus': 'bmi',
     'branch_eq': 'beq',
     'branch_ne': 'bne',
+    'branch_carry_clear': 'bcc',
+    'branch_carry_set': 'bcs',
 }
 
 immfns = {
@@ -43,12 +58,30 @@ regfns = {
         None,
         None
     ],
+    'decrement_register': [
+        'dex',
+        'dey',
+        None,
+        None
+    ],
     'store_register': [
         'stx',
         'sty',
         'sta',
         None
     ],
+    'transfer_from_accum': [
+        'tax',
+        'tay',
+        None,
+        None
+    ],
+    'transfer_to_accum': [
+        'txa',
+        'tya',
+        None,
+        None
+    ],
     'push': [
         'txs',
         None,
@@ -70,95 +103,420 @@ regfns = {
     ]
 }
 
+# register order of the opcode lists in regfns and immfns
+REGFN_REGISTERS = ['regx', 'regy', 'accum', 'proc']
+IMMFN_REGISTERS = ['accum', 'regx', 'regy']
+
+# builtins that take no operand besides an optional register
+NO_OPERAND_FNS = {'increment_register', 'decrement_register', 'transfer_from_accum', 'transfer_to_accum', 'push',
+                  'pull', 'halt', 'shift_left', 'shift_right', 'rotate_left', 'rotate_right', 'clear_carry',
+                  'set_carry'}
+
+
+# Stands in a macro's template before the expansion of a @constant_result
+# macro called with the template's own parameters; args are the called Macro,
+# how many instructions its expansion takes and the arguments it was given.
+# Expanding the template with numbers folds the call after all.
+FOLD_MARK = '.fold'
+
 
 class Macro:
     args: list[str]
-    ops = list[objasm.OpCode]
+    ops: list[objasm.OpCode]
+    # per instruction: mnemonic, operands, and (operand index, parameter index,
+    # prefix) for every operand that is filled from a parameter
+    template: list[tuple[str, tuple, tuple[tuple[int, int, str], ...]]]
+    # from @constant_result: the load_immediate opcode and the expression that
+    # replace the body when every argument is a number
+    fold: Union[tuple[str, ast.expr], None]
+    # whether the template holds FOLD_MARK instructions
+    folds: bool
+
+    def __init__(self, args: list[str], ops: list[objasm.OpCode], fold: tuple[str, ast.expr] = None) -> None:
+        self.args = args
+        self.ops = ops
+        self.fold = fold
+        self.folds = any(op.op == FOLD_MARK for op in ops)
+        params = {name: i for (i, name) in enumerate(args)}
+        self.template = []
+        for op in ops:
+            slots = tuple((i, params[arg[0]], arg[1]) for (i, arg) in enumerate(op.args) if type(arg) == list)
+            self.template.append((op.op, tuple(op.args), slots))
+
+    def expand(self, values: list) -> list[objasm.OpCode]:
+        codes = []
+        new_op = objasm.OpCode.from_interned
+        for (op, args, slots) in self.template:
+            if slots:
+                args = list(args)
+                for (i, param, prefix) in slots:
+                    value = values[param]
+                    if type(value) == list:
+                        # expanding inside another macro's body: stay a parameter of that macro
+                        args[i] = [value[0], prefix + value[1]]
+                    else:
+                        args[i] = prefix + value
+                codes.append(new_op(op, args))
+            else:
+                codes.append(new_op(op, list(args)))
+        return codes
+
+    def fold_values(self, values: list) -> Union[int, None]:
+        # the folded result, or None when an argument is not known at compile time
+        bound = {}
+        for (name, value) in zip(self.args, values):
+            if type(value) == list or _number(value) is None:
+                return None
+            bound[name] = value
+        return _evaluate(self.fold[1], None, bound)
+
+
+class Constants(dict):
+    # Constant name -> operand text. A module's assignments are declared before
+    # it is parsed and evaluated on first use, so a constant may refer to one
+    # assigned further down; `evaluating` catches definitions that loop, and
+    # `broken` holds constants whose error was already reported.
+    pending: dict[str, ast.Assign]
+    evaluating: list[str]
+    broken: set[str]
+
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+        self.pending = {}
+        self.evaluating = []
+        self.broken = set()
+
+
+CONST_BINOPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_,
+    ast.BitAnd: operator.and_,
+    ast.BitXor: operator.xor,
+}
+
+CONST_UNARYOPS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Invert: operator.invert,
+}
+
+# helpers callable inside constant expressions
+CONST_FUNCTIONS = {
+    'lo': lambda value: value & 0xff,
+    'hi': lambda value: value >> 8 & 0xff,
+}
+
+
+def _constant(name: str, consts, el: ast.expr = None) -> Union[str, None]:
+    if (value := consts.get(name)) is None:
+        pending = getattr(consts, 'pending', None)
+        if pending and name in pending:
+            return _evaluate_pending(name, consts)
+        if name in getattr(consts, 'broken', ()):
+            raise errors.ConstantError.create_custom(f'constant {name!r} has an error', el)
+    return value
+
+
+def _evaluate_pending(name: str, consts: Constants) -> str:
+    node = consts.pending[name]
+    if name in consts.evaluating:
+        cycle = consts.evaluating[consts.evaluating.index(name):] + [name]
+        raise errors.ConstantCycleError.create_custom(cycle, node)
+    consts.evaluating.append(name)
+    try:
+        value = _parse_arg(node.value, None, consts)
+    except errors.PyASMError:
+        # every constant being evaluated depends on the one that failed
+        for broken in consts.evaluating:
+            consts.pending.pop(broken, None)
+            consts.broken.add(broken)
+        raise
+    finally:
+        consts.evaluating.pop()
+    for targ in node.targets:
+        if consts.pending.get(targ.id) is node:
+            del consts.pending[targ.id]
+        consts[targ.id] = value
+    return value
+
+
+def _declare_constants(root: ast.Module, consts: Constants) -> None:
+    for branch in root.body:
+        if type(branch) == ast.Assign:
+            for targ in branch.targets:
+                consts.pending.setdefault(targ.id, branch)
+
+
+def _assign_constant(node: ast.Assign, consts) -> None:
+    pending = getattr(consts, 'pending', {})
+    for targ in node.targets:
+        if pending.get(targ.id) is node:
+            _evaluate_pending(targ.id, consts)
+            return
+        if targ.id in getattr(consts, 'broken', ()):
+            return
+    # evaluated early by a forward reference, or a name assigned twice
+    value = _parse_arg(node.value, None, consts)
+    for targ in node.targets:
+        consts[targ.id] = value
 
 
-def _parse_arg(arg: Union[ast.Name, ast.Constant], macargs=None, consts=None) -> str:
+def _number(text: str) -> Union[int, None]:
+    try:
+        return int(text[1:], 16) if text.startswith('$') else int(text, 0)
+    except ValueError:
+        return None
+
+
+def _evaluate(node: ast.expr, macargs, consts) -> int:
+    nodetype = type(node)
+    if nodetype == ast.Constant:
+        if type(node.value) != int:
+            raise errors.ConstantError.create_custom(f'{node.value!r} is not a number', node)
+        return node.value
+    elif nodetype == ast.Name:
+        if macargs is not None and node.id in macargs:
+            raise errors.ConstantError.create_custom(
+                f'macro parameter {node.id!r} cannot be used in a constant expression', node)
+        value = _constant(node.id, consts, node) if consts is not None else None
+        if value is None:
+            raise errors.ConstantError.create_custom(f'{node.id!r} is not a constant', node)
+        if (number := _number(value)) is None:
+            raise errors.ConstantError.create_custom(f'constant {node.id!r} is {value!r}, not a number', node)
+        return number
+    elif nodetype == ast.BinOp and type(node.op) == ast.Div:
+        raise errors.ConstantError.create_custom('constant expressions divide with //, not /', node)
+    elif nodetype == ast.BinOp and (fn := CONST_BINOPS.get(type(node.op))) is not None:
+        left = _evaluate(node.left, macargs, consts)
+        right = _evaluate(node.right, macargs, consts)
+        try:
+            return fn(left, right)
+        except (ZeroDivisionError, ValueError) as e:
+            raise errors.ConstantError.create_custom(str(e), node)
+    elif nodetype == ast.UnaryOp and (fn := CONST_UNARYOPS.get(type(node.op))) is not None:
+        return fn(_evaluate(node.operand, macargs, consts))
+    elif nodetype == ast.Call and type(node.func) == ast.Name and node.func.id in CONST_FUNCTIONS:
+        if len(node.args) != 1:
+            raise errors.ConstantError.create_custom(f'{node.func.id}() takes 1 argument, got {len(node.args)}', node)
+        return CONST_FUNCTIONS[node.func.id](_evaluate(node.args[0], macargs, consts))
+    raise errors.UnsupportedSyntaxElement.create_custom(
+        'constant expression',
+        node.lineno,
+        node.col_offset,
+        node
+    )
+
+
+def _parse_arg(arg: ast.expr, macargs=None, consts=None) -> str:
     if isinstance(arg, ast.Name):
         if macargs is not None and arg.id in macargs:
             return [arg.id, '']
-        if consts is not None and arg.id in consts:
-            return consts[arg.id]
+        if consts is not None and (value := _constant(arg.id, consts, arg)) is not None:
+            return value
         return arg.id
-    return str(arg.value)
-
-
-def _fill_macro(macro: list[objasm.OpCode], args: dict[str, str]):
-    copy = []
-    for item in macro:
-        item_copy = objasm.OpCode(**item.get_parts())
-        for (i, arg) in enumerate(item_copy.args):
-            if type(arg) == list:
-                # newarg = 
-                if type(args[arg[0]]) == list:
-                    newarg = [args[arg[0]][0], arg[1] + args[arg[0]][1]]
-                else:
-                    newarg = arg[1] + args[arg[0]]
-                item_copy.args[i] = newarg
-        copy.append(item_copy)
-    return copy
+    if isinstance(arg, ast.Constant):
+        return str(arg.value)
+    # anything else is folded to a number at compile time
+    return str(_evaluate(arg, macargs, consts))
 
 
-def _parse_pycall(call: ast.Call, macros: dict, macargs, consts) -> list[objasm.OpCode]:
-    fname = call.func.id
-    if fname in macros:
-        return _fill_macro(macros[fname].ops, {ar: _parse_arg(ca, macargs, consts) for (ar, ca) in zip(macros[fname].args, call.args)})
-    elif fname in fns:
-        args = [_parse_arg(arg, macargs, consts) for arg in call.args]
-        return [objasm.OpCode(op=fns[fname], args=args)]
-    elif fname in dirimmfns:
-        args = []
-        for arg in call.args:
-            args.append(_parse_arg(arg, macargs, consts))
-            if type(args[-1]) == list:
-                args[-1][1] = '#'
-            else:
-                args[-1] = '#' + args[-1]
-        return [objasm.OpCode(op=dirimmfns[fname], args=args)]
-    elif fname in regfns:
-        regstr = call.args[0].id
-        opix = {
-            'regx': 0,
-            'regy': 1,
-            'accum': 2,
-            'proc': 3
-        }.get(regstr)
-        if opix is None:
+def _immediate(arg):
+    if type(arg) == list:
+        arg[1] = '#'
+        return arg
+    return '#' + arg
+
+
+def _arity_error(call: ast.Call, fname: str, expected: int) -> errors.UnsupportedFunctionOrElement:
+    return errors.UnsupportedFunctionOrElement.create_custom(
+        'call',
+        f': {fname!r} takes {expected} argument(s), got {len(call.args)}',
+        call.lineno,
+        fname
+    )
+
+
+def _operand_handler(fname: str, op: str, immediate: bool) -> 'Handler':
+    op = sys.intern(op)
+    nargs = 0 if fname in NO_OPERAND_FNS else 1
+    new_op = objasm.OpCode.from_interned
+
+    def handler(call: ast.Call, macargs, consts) -> list[objasm.OpCode]:
+        if len(call.args) != nargs:
+            raise _arity_error(call, fname, nargs)
+        if not nargs:
+            return [new_op(op, [])]
+        arg = _parse_arg(call.args[0], macargs, consts)
+        return [new_op(op, [_immediate(arg) if immediate else arg])]
+    return handler
+
+
+def _register_handler(fname: str, ops: dict[str, str], immediate: bool) -> 'Handler':
+    ops = {reg: sys.intern(op) for (reg, op) in ops.items() if op is not None}
+    nargs = 1 if fname in NO_OPERAND_FNS else 2
+    new_op = objasm.OpCode.from_interned
+
+    def handler(call: ast.Call, macargs, consts) -> list[objasm.OpCode]:
+        args = call.args
+        if len(args) != nargs:
+            raise _arity_error(call, fname, nargs)
+        reg = args[0]
+        op = ops.get(reg.id) if type(reg) == ast.Name else None
+        if op is None:
             raise errors.UnsupportedFunctionOrElement.create_custom(
                 'register',
-                f' {call.args[0].id!r} for {fname!r}',
+                f' {ast.unparse(reg)!r} for {fname!r}',
                 call.lineno,
                 fname
             )
-        args = [_parse_arg(arg, macargs, consts) for arg in call.args[1:]]
-        return [objasm.OpCode(op=regfns[fname][opix], args=args)]
-    elif fname in immfns:
-        regstr = call.args[0].id
-        opix = {
-            'accum': 0,
-            'regx': 1,
-            'regy': 2
-        }.get(regstr)
-        if opix is None:
+        if nargs == 1:
+            return [new_op(op, [])]
+        arg = _parse_arg(args[1], macargs, consts)
+        return [new_op(op, [_immediate(arg) if immediate else arg])]
+    return handler
+
+
+def _halt_handler(call: ast.Call, macargs, consts) -> list[objasm.OpCode]:
+    if call.args:
+        raise _arity_error(call, 'halt', 0)
+    return [objasm.OpCode(op='jmp', args=[objasm.HALT_LABEL])]
+
+
+Handler = Callable[[ast.Call, list, dict], list[objasm.OpCode]]
+DispatchTable = dict[str, Handler]
+
+
+def build_dispatch() -> DispatchTable:
+    # every builtin gets a handler with its opcode (or per-register opcodes) resolved up front
+    dispatch = {}
+    for (fname, op) in fns.items():
+        dispatch[fname] = _operand_handler(fname, op, False)
+    for (fname, op) in dirimmfns.items():
+        dispatch[fname] = _operand_handler(fname, op, True)
+    for (fname, ops) in regfns.items():
+        dispatch[fname] = _register_handler(fname, dict(zip(REGFN_REGISTERS, ops)), False)
+    for (fname, ops) in immfns.items():
+        dispatch[fname] = _register_handler(fname, dict(zip(IMMFN_REGISTERS, ops)), True)
+    dispatch['halt'] = _halt_handler
+    return dispatch
+
+
+DISPATCH = build_dispatch()
+
+# functions in pyasm.stubs that are handled outside of statements
+SPECIAL_STUBS = {'inline_macro', 'constant_result', 'prefer_inline', 'reserve_label'}
+
+
+def check_stubs() -> list[str]:
+    import inspect
+    from pyasm import stubs
+    problems = []
+    stub_fns = {name: fn for (name, fn) in vars(stubs).items()
+                if inspect.isfunction(fn) and fn.__module__ == stubs.__name__}
+    builtins = DISPATCH.keys() | CONST_FUNCTIONS.keys()
+    for name in builtins - stub_fns.keys():
+        problems.append(f'{name!r} has no stub')
+    for name in stub_fns.keys() - builtins - SPECIAL_STUBS:
+        problems.append(f'stub {name!r} is not a builtin')
+    for name in stub_fns.keys() & CONST_FUNCTIONS.keys():
+        if len(inspect.signature(stub_fns[name]).parameters) != 1:
+            problems.append(f'stub {name!r} should take one value')
+    for name in stub_fns.keys() & DISPATCH.keys():
+        params = list(inspect.signature(stub_fns[name]).parameters)
+        takes_reg = name in regfns or name in immfns
+        expected = (1 if takes_reg else 0) + (0 if name in NO_OPERAND_FNS else 1)
+        if len(params) != expected:
+            problems.append(f'stub {name!r} takes {len(params)} parameter(s), the builtin takes {expected}')
+        elif takes_reg and params[0] != 'reg':
+            problems.append(f'stub {name!r} should take the register as its first parameter')
+    return sorted(problems)
+
+
+def _fold_macro(call: ast.Call, macro: Macro, values: list) -> Union[list[objasm.OpCode], None]:
+    value = macro.fold_values(values)
+    if value is None:
+        return None
+    if not 0 <= value <= 0xff:
+        raise errors.ConstantError.create_custom(
+            f'{call.func.id}() folds to {value}, which does not fit in a register', call)
+    if (prof := instrument.ACTIVE) is not None:
+        prof.count('macros folded')
+    return [objasm.OpCode(op=macro.fold[0], args=['#' + str(value)])]
+
+
+def _resolve_folds(codes: list[objasm.OpCode], call: ast.Call) -> list[objasm.OpCode]:
+    # a template expanded with every argument known: each marked call folds if
+    # its arguments turned out to be numbers and stays expanded otherwise
+    out = []
+    ix = 0
+    while ix < len(codes):
+        op = codes[ix]
+        ix += 1
+        if op.op != FOLD_MARK:
+            out.append(op)
+            continue
+        macro, count, values = op.args[0], op.args[1], op.args[2:]
+        if (folded := _fold_macro(call, macro, values)) is not None:
+            out.extend(folded)
+            ix += count
+    return out
+
+
+def _constant_result(fn: ast.FunctionDef) -> Union[tuple[str, ast.expr], None]:
+    for dec in fn.decorator_list:
+        if not (type(dec) == ast.Call and type(dec.func) == ast.Name and dec.func.id == 'constant_result'):
+            continue
+        if len(dec.args) != 2:
+            raise _arity_error(dec, 'constant_result', 2)
+        reg, expr = dec.args
+        ops = dict(zip(IMMFN_REGISTERS, immfns['load_immediate']))
+        if type(reg) != ast.Name or reg.id not in ops:
             raise errors.UnsupportedFunctionOrElement.create_custom(
                 'register',
-                f' {call.args[0].id!r} for {fname!r}',
+                f' {ast.unparse(reg)!r} for {"constant_result"!r}',
+                dec.lineno,
+                'constant_result'
+            )
+        return ops[reg.id], expr
+    return None
+
+
+def _parse_pycall(call: ast.Call, macros: dict, macargs, consts) -> list[objasm.OpCode]:
+    fname = call.func.id
+    if (macro := macros.get(fname)) is not None:
+        if len(call.args) != len(macro.args):
+            raise errors.UnsupportedFunctionOrElement.create_custom(
+                'macro call',
+                f': {fname!r} takes {len(macro.args)} argument(s), got {len(call.args)}',
                 call.lineno,
                 fname
             )
-        args = []
-        for arg in call.args[1:]:
-            args.append(_parse_arg(arg, macargs, consts))
-            if type(args[-1]) == list:
-                args[-1][1] = '#'
-            else:
-                args[-1] = '#' + args[-1]
-        return [objasm.OpCode(op=immfns[fname][opix], args=args)]
-    elif fname == 'halt':
-        return [objasm.OpCode(op='jmp', args=['___hlt___'])]
+        values = [_parse_arg(arg, macargs, consts) for arg in call.args]
+        if macro.fold is not None and (codes := _fold_macro(call, macro, values)) is not None:
+            return codes
+        if (prof := instrument.ACTIVE) is not None:
+            prof.count('macros expanded')
+            prof.enter('macro expansion')
+            codes = macro.expand(values)
+            prof.leave()
+        else:
+            codes = macro.expand(values)
+        if macro.fold is None and not macro.folds:
+            return codes
+        if any(type(value) == list for value in values):
+            # inside another macro's body, called with its parameters
+            if macro.fold is not None:
+                return [objasm.OpCode(op=FOLD_MARK, args=[macro, len(codes)] + values)] + codes
+            return codes
+        return _resolve_folds(codes, call)
+    elif (handler := DISPATCH.get(fname)) is not None:
+        return handler(call, macargs, consts)
     else:
         raise errors.UnsupportedFunctionOrElement.create_custom(
             'function',
@@ -169,9 +527,8 @@ def _parse_pycall(call: ast.Call, macros: dict, macargs, consts) -> list[objasm.
 
 
 def _parse_code(code: Union[ast.Expr, ast.Pass, ast.Return], macros: dict, macargs, consts) -> list[objasm.OpCode]:
-    if isinstance(code, ast.Pass):
-        return [objasm.OpCode(op='nop', args=[])]
-    elif isinstance(code, ast.Expr):
+    # calls are by far the most common statement, so they are tested first
+    if isinstance(code, ast.Expr):
         if isinstance(code.value, ast.Call):
             return _parse_pycall(code.value, macros, macargs, consts)
         else:
@@ -181,6 +538,8 @@ def _parse_code(code: Union[ast.Expr, ast.Pass, ast.Return], macros: dict, macar
                 code.value.col_offset,
                 code.value
             )
+    elif isinstance(code, ast.Pass):
+        return [objasm.OpCode(op='nop', args=[])]
     elif isinstance(code, ast.Return):
         return [objasm.OpCode(op='rts', args=[])]
     else:
@@ -192,35 +551,325 @@ def _parse_code(code: Union[ast.Expr, ast.Pass, ast.Return], macros: dict, macar
         )
 
 
-def _parse_function(fn: ast.FunctionDef, macros: dict, consts, ismacro=False) -> objasm.Label:
+# the branch a while loop takes back to its top while `reg <op> value` holds
+LOOP_BRANCHES = {ast.Eq: 'beq', ast.NotEq: 'bne', ast.Lt: 'bcc', ast.GtE: 'bcs'}
+INVERSE_BRANCHES = {'beq': 'bne', 'bne': 'beq', 'bcc': 'bcs', 'bcs': 'bcc'}
+# counter register of a for loop -> how it is loaded and counted down
+LOOP_COUNTERS = {'regx': ('ldx', 'dex'), 'regy': ('ldy', 'dey')}
+LOOP_STATEMENTS = (ast.For, ast.While, ast.Break, ast.Continue)
+# a relative branch reaches at most this many bytes back from its own end
+MAX_BRANCH_BACK = 128
+
+
+class Loop:
+    # where break and continue jump to; the labels are only started when used
+    top: str
+    next_name: str
+    end_name: str
+    continued: bool
+    broken: bool
+    register: Union[str, None]  # the register a for loop counts in
+
+    def __init__(self, base: str, register: Union[str, None] = None) -> None:
+        self.top = base
+        self.register = register
+        self.next_name = base + '_next'
+        self.end_name = base + '_end'
+        self.continued = False
+        self.broken = False
+
+
+class FunctionBody:
+    # The labels a function compiles to. Code goes into the last one; loops
+    # start new labels for their top, their test and their end.
+    labels: list[objasm.Label]
+    loops: list[Loop]
+    count: int
+
+    def __init__(self, label: objasm.Label) -> None:
+        self.labels = [label]
+        self.loops = []
+        self.count = 0
+
+    @property
+    def codes(self) -> list[objasm.OpCode]:
+        return self.labels[-1].codes
+
+    def start_label(self, name: str) -> None:
+        self.labels.append(objasm.Label(name=name, codes=[]))
+
+    def new_loop(self, register: Union[str, None] = None) -> Loop:
+        self.count += 1
+        loop = Loop(f'{self.labels[0].name}__loop{self.count}', register)
+        self.loops.append(loop)
+        return loop
+
+    def close_loop(self, loop: Loop, first: int, branch: str) -> None:
+        # branches back to the top; a body too long for a relative branch
+        # skips over a jmp with the opposite branch instead
+        size = sum(opcodes.instruction_size(op.op, op.args) for label in self.labels[first:] for op in label.codes
+                   if op.op in opcodes.OPCODES)
+        if size + opcodes.MODE_SIZES['rel'] <= MAX_BRANCH_BACK:
+            self.codes.append(objasm.OpCode(op=branch, args=[loop.top]))
+        else:
+            self.codes.append(objasm.OpCode(op=INVERSE_BRANCHES[branch], args=[loop.end_name]))
+            self.codes.append(objasm.OpCode(op='jmp', args=[loop.top]))
+            loop.broken = True
+        self.loops.pop()
+        if loop.broken:
+            self.start_label(loop.end_name)
+
+
+def _parse_for(loop_node: ast.For, body: FunctionBody, macros: dict, consts, collector) -> None:
+    # for regx in range(n): counts the register down from n to 1, testing at the bottom
+    target, it = loop_node.target, loop_node.iter
+    if type(target) != ast.Name or target.id not in LOOP_COUNTERS:
+        raise errors.LoopError.create_custom('a for loop counts in regx or regy', target)
+    if not (type(it) == ast.Call and type(it.func) == ast.Name and it.func.id == 'range'
+            and len(it.args) == 1 and not it.keywords):
+        raise errors.LoopError.create_custom('a for loop runs over range(count)', it)
+    if loop_node.orelse:
+        raise errors.LoopError.create_custom('loops cannot have an else block', loop_node.orelse[0])
+    count = _evaluate(it.args[0], None, consts)
+    if not 0 <= count <= 0x100:
+        raise errors.LoopError.create_custom(f'a for loop runs 0 to 256 times, not {count}', it)
+    if not count:
+        return
+    if any(outer.register == target.id for outer in body.loops):
+        raise errors.LoopError.create_custom(f'an enclosing for loop already counts in {target.id}', target)
+    load, decrement = LOOP_COUNTERS[target.id]
+    # a count of 256 is loaded as 0, which the first decrement turns into 255
+    body.codes.append(objasm.OpCode(op=load, args=['#' + str(count & 0xff)]))
+    first = len(body.labels)
+    loop = body.new_loop(target.id)
+    body.start_label(loop.top)
+    _parse_statements(loop_node.body, body, macros, None, consts, collector)
+    if loop.continued:
+        body.start_label(loop.next_name)
+    body.codes.append(objasm.OpCode(op=decrement, args=[]))
+    body.close_loop(loop, first, 'bne')
+
+
+def _parse_while(loop_node: ast.While, body: FunctionBody, macros: dict, consts, collector) -> None:
+    # while True: loops until a break; while reg <op> value: jumps to the test
+    # at the bottom once, so every iteration costs a compare and a branch
+    test = loop_node.test
+    if loop_node.orelse:
+        raise errors.LoopError.create_custom('loops cannot have an else block', loop_node.orelse[0])
+    if type(test) == ast.Constant and test.value is True:
+        loop = body.new_loop()
+        loop.next_name = loop.top
+        body.start_label(loop.top)
+        _parse_statements(loop_node.body, body, macros, None, consts, collector)
+        body.codes.append(objasm.OpCode(op='jmp', args=[loop.top]))
+        body.loops.pop()
+        if loop.broken:
+            body.start_label(loop.end_name)
+        return
+    compares = dict(zip(REGFN_REGISTERS, regfns['compare']))
+    if not (type(test) == ast.Compare and len(test.ops) == 1 and type(test.left) == ast.Name
+            and compares.get(test.left.id) is not None and type(test.ops[0]) in LOOP_BRANCHES):
+        raise errors.LoopError.create_custom(
+            'a while loop tests True or a register against a value with ==, !=, < or >=', test)
+    value = _evaluate(test.comparators[0], None, consts)
+    if not 0 <= value <= 0xff:
+        raise errors.LoopError.create_custom(f'{value} does not fit in a register', test.comparators[0])
+    loop = body.new_loop()
+    body.codes.append(objasm.OpCode(op='jmp', args=[loop.next_name]))
+    first = len(body.labels)
+    body.start_label(loop.top)
+    _parse_statements(loop_node.body, body, macros, None, consts, collector)
+    body.start_label(loop.next_name)
+    body.codes.append(objasm.OpCode(op=compares[test.left.id], args=['#' + str(value)]))
+    body.close_loop(loop, first, LOOP_BRANCHES[type(test.ops[0])])
+
+
+def _parse_loop_statement(stmt: ast.stmt, body: FunctionBody, macros: dict, macargs, consts, collector) -> None:
+    if macargs is not None:
+        raise errors.LoopError.create_custom('loops cannot be used in macros', stmt)
+    stmttype = type(stmt)
+    if stmttype == ast.For:
+        _parse_for(stmt, body, macros, consts, collector)
+    elif stmttype == ast.While:
+        _parse_while(stmt, body, macros, consts, collector)
+    else:
+        keyword = 'break' if stmttype == ast.Break else 'continue'
+        if not body.loops:
+            raise errors.LoopError.create_custom(f'{keyword} outside a loop', stmt)
+        loop = body.loops[-1]
+        if stmttype == ast.Break:
+            loop.broken = True
+            body.codes.append(objasm.OpCode(op='jmp', args=[loop.end_name]))
+        else:
+            loop.continued = True
+            body.codes.append(objasm.OpCode(op='jmp', args=[loop.next_name]))
+
+
+def _parse_statements(stmts: list[ast.stmt], body: FunctionBody, macros: dict, macargs, consts,
+                      collector: errors.ErrorCollector) -> None:
+    for stmt in stmts:
+        if collector is None:
+            if isinstance(stmt, LOOP_STATEMENTS):
+                _parse_loop_statement(stmt, body, macros, macargs, consts, collector)
+            else:
+                body.codes.extend(_parse_code(stmt, macros, macargs, consts))
+            continue
+        # keep going after an error: a failed statement is left out
+        try:
+            if isinstance(stmt, LOOP_STATEMENTS):
+                _parse_loop_statement(stmt, body, macros, macargs, consts, collector)
+            else:
+                body.codes.extend(_parse_code(stmt, macros, macargs, consts))
+        except errors.PyASMError as e:
+            collector.add(e)
+
+
+def _parse_function(fn: ast.FunctionDef, macros: dict, consts, ismacro=False,
+                    collector: errors.ErrorCollector = None) -> list[objasm.Label]:
+    # one label, plus the labels of any loops in it
     result = objasm.Label(name=fn.name, codes=[])
+    result.inline = any(type(dec) == ast.Name and dec.id == 'prefer_inline' for dec in fn.decorator_list)
     macargs = None
     if ismacro:
         macargs = [arg.arg for arg in fn.args.args]
-    for body_part in fn.body:
-        result.codes.extend(_parse_code(body_part, macros, macargs, consts))
+    body = FunctionBody(result)
+    _parse_statements(fn.body, body, macros, macargs, consts, collector)
     if ismacro:
-        newmac = Macro()
-        newmac.args = macargs
-        newmac.ops = result.codes
-        macros[fn.name] = newmac
-    return result
+        # nested macro calls were already expanded into result.codes, so the
+        # template is flat however deep the nesting goes; FOLD_MARK keeps the
+        # @constant_result calls among them foldable
+        macros[fn.name] = Macro(macargs, result.codes, _constant_result(fn))
+    return body.labels
+
+
+class FunctionCache:
+    # Parsed functions kept across compilations by a long-running process. An
+    # entry is reused while the function's source and every macro and constant
+    # it names are unchanged. A cached macro keeps its Macro object, so code
+    # calling an unchanged macro stays cached as well.
+    entries: dict[str, tuple[tuple, list[objasm.Label], Union[Macro, None]]]
+    hits: int
+    misses: int
+
+    def __init__(self) -> None:
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
 
+    def parse(self, fn: ast.FunctionDef, macros: dict, consts, ismacro=False,
+              collector: errors.ErrorCollector = None) -> list[objasm.Label]:
+        key = ast.dump(fn)
+        names = sorted({node.id for node in ast.walk(fn) if type(node) == ast.Name})
+        try:
+            uses = tuple((name, macros.get(name), _constant(name, consts)) for name in names)
+        except errors.PyASMError:
+            # a broken constant is reported where the function uses it
+            uses = None
+        entry = self.entries.get(key)
+        if entry is not None and uses is not None and entry[0] == uses:
+            self.hits += 1
+            _, result, macro = entry
+            if macro is not None:
+                macros[fn.name] = macro
+            return result
+        self.misses += 1
+        failed = len(collector.errors) if collector is not None else 0
+        result = _parse_function(fn, macros, consts, ismacro, collector)
+        # a function with errors must report them again next time
+        if uses is not None and (collector is None or len(collector.errors) == failed):
+            self.entries[key] = (uses, result, macros[fn.name] if ismacro else None)
+        return result
+
+
+BUILTIN_MODULE_DIR = os.path.join(os.path.dirname(__file__), 'builtin-modules')
 
 MODULE_PATH = [
     '.',
-    os.path.join(os.path.dirname(__file__), 'builtin-modules')
+    BUILTIN_MODULE_DIR
 ]
 
 MODULE_EXTS = ['.pyasm', '.py']
 
+DirListing = dict[str, list[str]]
+
+
+class ModuleIndex:
+    def __init__(self, search_path: list[str]) -> None:
+        self.search_path = search_path
+        self.entries: DirListing = {}
+        self.scan()
+
+    @staticmethod
+    def _scan_dir(dirname: str) -> DirListing:
+        extorder = {ext: i for (i, ext) in enumerate(MODULE_EXTS)}
+        found = {}
+        try:
+            with os.scandir(dirname) as it:
+                for entry in it:
+                    name, ext = os.path.splitext(entry.name)
+                    if (prof := instrument.ACTIVE) is not None:
+                        prof.count('files probed')
+                    if ext in extorder and entry.is_file():
+                        found.setdefault(name, []).append((extorder[ext], entry.path))
+        except OSError:
+            return {}
+        return {name: [path for (_, path) in sorted(paths)] for (name, paths) in found.items()}
+
+    def scan(self) -> None:
+        dirnames = list(dict.fromkeys(os.path.abspath(dirname) for dirname in self.search_path))
+        stored = cache.load_index(dirnames) or {}
+        listings = {}
+        for dirname in dirnames:
+            try:
+                mtime = os.stat(dirname).st_mtime_ns
+            except OSError:
+                mtime = None
+            if dirname in stored and stored[dirname][0] == mtime:
+                listings[dirname] = stored[dirname]
+            else:
+                listings[dirname] = (mtime, self._scan_dir(dirname) if mtime is not None else {})
+        if listings != stored:
+            cache.store_index(dirnames, listings)
+        self.entries = {}
+        for (_, found) in listings.values():
+            for (name, paths) in found.items():
+                self.entries.setdefault(name, []).extend(paths)
+
+    def find(self, name: str) -> Union[str, None]:
+        paths = self.entries.get(name)
+        return paths[0] if paths else None
+
+    def candidates(self, name: str) -> list[str]:
+        # the first entry is the one that is imported, the rest are shadowed by it
+        return list(self.entries.get(name, []))
+
+
+_module_index: Union[ModuleIndex, None] = None
+
+
+def module_index() -> ModuleIndex:
+    global _module_index
+    search_path = MODULE_PATH + sys.path
+    if _module_index is None or _module_index.search_path != search_path:
+        _module_index = ModuleIndex(search_path)
+    return _module_index
+
+
+def invalidate_module_index() -> None:
+    global _module_index
+    _module_index = None
+    cache.clear_index()
+
+
 def find_module(name: str) -> Union[str, None]:
-    for dirname in MODULE_PATH + sys.path:
-        for ext in MODULE_EXTS:
-            patt = os.path.join(dirname, name + ext)
-            for filepath in glob.iglob(patt):
-                return filepath
-    return None
+    if (prof := instrument.ACTIVE) is not None:
+        prof.count('find_module calls')
+        prof.enter('module lookup')
+        try:
+            return module_index().find(name)
+        finally:
+            prof.leave()
+    return module_index().find(name)
 
 
 MacroDict = dict[str, Macro]
@@ -228,74 +877,240 @@ ConstantDict = dict[str, str]
 LabelList = list[str]
 
 
-def parse2(root: ast.Module, _recurc: int = 0) -> tuple[objasm.Program, MacroDict, ConstantDict, LabelList]:
-    result = objasm.Program(labels=[])
-    reserved_labels = []
-    macros = {}
-    consts = {}
-    for branch in root.body:
-        if type(branch) == ast.ImportFrom:
-            if branch.module == 'pyasm.stubs':
-                continue
-            elif (filepath := find_module(branch.module)) is not None:
+ModuleStamps = dict[str, tuple[int, int, str]]
+# import name -> the file it resolved to, for this module and everything it imports
+ModuleImports = dict[str, str]
+
+
+class Module:
+    filepath: str
+    # labels in source order; a str entry marks where an imported module goes
+    body: list[Union[objasm.Label, str]]
+    macros: MacroDict
+    consts: ConstantDict
+    reserved_labels: LabelList
+    deps: ModuleStamps
+    imports: ModuleImports
+
+
+class ModuleGraph:
+    def __init__(self, shared: dict[str, Module] = None, functions: FunctionCache = None,
+                 collector: errors.ErrorCollector = None) -> None:
+        self.modules: dict[str, Module] = {}
+        self.loading: list[str] = []
+        # modules kept across compilations in a long-running process; they are
+        # never modified once parsed, so graphs can hand out the same objects
+        self.shared = shared
+        self.functions = functions
+        # set to keep parsing after errors instead of raising the first one
+        self.collector = collector
+        # the module being compiled, once parse() or parse2() has parsed it
+        self.entry: Union[Module, None] = None
+
+    def load(self, filepath: str, lineno: int = None) -> Module:
+        filepath = os.path.abspath(filepath)
+        if (module := self.modules.get(filepath)) is not None:
+            return module
+        if filepath in self.loading:
+            cycle = self.loading[self.loading.index(filepath):] + [filepath]
+            raise errors.ImportCycleError.create_custom(cycle, lineno)
+        if self.shared is not None:
+            module = self.shared.get(filepath)
+        else:
+            module = None
+        prof = instrument.ACTIVE
+        if module is None:
+            if prof is not None:
+                prof.enter('module cache', filepath)
+            resolve = module_index().find
+            module = cache.load_prebuilt(filepath, resolve)
+            if module is None:
+                module = cache.load(filepath, resolve=resolve)
+            if prof is not None:
+                prof.leave()
+                if module is not None:
+                    prof.count('modules loaded from cache')
+        if module is None:
+            failed = len(self.collector.errors) if self.collector is not None else 0
+            self.loading.append(filepath)
+            try:
                 with open(filepath, 'r') as fp:
-                    new_module = ast.parse(fp.read(), filepath)
-                result.labels.append(objasm.Label(name=f'___jts1_{_recurc}___', codes=[
-                    objasm.OpCode(op='jmp', args=[f'___jts2_{_recurc}___'])
-                ]))
-                new_result, new_macros, new_consts, new_reserved = parse2(new_module, _recurc + 1)
-                result.labels.extend(new_result.labels)
-                macros.update(new_macros)
-                consts.update(new_consts)
-                reserved_labels.extend(new_reserved)
-                result.labels.append(objasm.Label(name=f'___jts2_{_recurc}___', codes=[]))
-            else:
-                raise errors.NoModuleError.create_custom(branch.module, branch.lineno)
-        elif type(branch) == ast.FunctionDef:
-            macro = False
-            for dec in branch.decorator_list:
-                if isinstance(dec, ast.Name) and dec.id == 'inline_macro':
-                    macro = True
-            parse_result = _parse_function(branch, macros, consts, macro)
-            if not macro:
-                result.labels.append(parse_result)
-        elif type(branch) == ast.Expr:
-            if isinstance(branch.value, ast.Call):
-                if branch.value.func.id == 'reserve_label':
-                    reserved_labels.append(_parse_arg(branch.value.args[0], None, consts))
+                    source = fp.read()
+                if prof is not None:
+                    prof.count('modules parsed')
+                    prof.enter('ast.parse', filepath)
+                    try:
+                        tree = ast.parse(source, filepath)
+                    finally:
+                        prof.leave()
+                    prof.enter('parse', filepath)
+                    try:
+                        module = _parse_module(tree, self, filepath)
+                    finally:
+                        prof.leave()
                 else:
-                    raise errors.UnsupportedFunctionOrElement.create_custom(
-                        'top-level function',
-                        f': {branch.value.func.id!r}',
-                        branch.value.lineno,
-                        branch.value.func.id
-                    )
+                    tree = ast.parse(source, filepath)
+                    module = _parse_module(tree, self, filepath)
+            except errors.PyASMError as e:
+                if e.filename is None:
+                    e.filename = filepath
+                raise
+            finally:
+                self.loading.pop()
+            if self.collector is not None and len(self.collector.errors) != failed:
+                # only a module without errors may be reused
+                self.modules[filepath] = module
+                return module
+            if prof is not None:
+                prof.enter('module cache', filepath)
+            cache.store(filepath, module.deps, module, imports=module.imports)
+            if prof is not None:
+                prof.leave()
+        if self.shared is not None:
+            self.shared[filepath] = module
+        self.modules[filepath] = module
+        return module
+
+    def link(self, module: Module) -> tuple[list[objasm.Label], list[objasm.Label]]:
+        # The entry module's own code comes first and every imported module's
+        # code goes after it, once each, so nothing has to jump over libraries.
+        entry = [item for item in module.body if isinstance(item, objasm.Label)]
+        library = []
+        self._link_imports(module, library, set())
+        return entry, library
+
+    def _link_imports(self, module: Module, labels: list[objasm.Label], emitted: set[str]) -> None:
+        for item in module.body:
+            if isinstance(item, str) and item not in emitted:
+                emitted.add(item)
+                imported = self.load(item)
+                labels.extend(label for label in imported.body if isinstance(label, objasm.Label))
+                self._link_imports(imported, labels, emitted)
+
+
+def prebuild() -> list[str]:
+    # parses every builtin module and stores it as a prebuilt module
+    graph = ModuleGraph()
+    built = []
+    for filename in sorted(os.listdir(BUILTIN_MODULE_DIR)):
+        if os.path.splitext(filename)[1] in MODULE_EXTS:
+            module = graph.load(os.path.join(BUILTIN_MODULE_DIR, filename))
+            cache.store_prebuilt(module.filepath, module.deps, module, module.imports)
+            built.append(module.filepath)
+    return built
+
+
+def _parse_toplevel(branch: ast.stmt, graph: ModuleGraph, module: Module) -> None:
+    if type(branch) == ast.ImportFrom:
+        if branch.module == 'pyasm.stubs':
+            return
+        elif (import_path := find_module(branch.module)) is not None:
+            new_module = graph.load(import_path, branch.lineno)
+            module.body.append(new_module.filepath)
+            module.macros.update(new_module.macros)
+            module.consts.update(new_module.consts)
+            module.reserved_labels.extend(new_module.reserved_labels)
+            module.deps.update(new_module.deps)
+            module.imports.update(new_module.imports)
+            module.imports[branch.module] = import_path
+        else:
+            raise errors.NoModuleError.create_custom(branch.module, branch.lineno)
+    elif type(branch) == ast.FunctionDef:
+        macro = False
+        for dec in branch.decorator_list:
+            if isinstance(dec, ast.Name) and dec.id == 'inline_macro':
+                macro = True
+        if graph.functions is not None:
+            parse_result = graph.functions.parse(branch, module.macros, module.consts, macro, graph.collector)
+        else:
+            parse_result = _parse_function(branch, module.macros, module.consts, macro, graph.collector)
+        if not macro:
+            module.body.extend(parse_result)
+    elif type(branch) == ast.Expr:
+        if isinstance(branch.value, ast.Call):
+            if branch.value.func.id == 'reserve_label':
+                module.reserved_labels.append(_parse_arg(branch.value.args[0], None, module.consts))
             else:
-                raise errors.UnsupportedSyntaxElement.create_custom(
-                    'body',
+                raise errors.UnsupportedFunctionOrElement.create_custom(
+                    'top-level function',
+                    f': {branch.value.func.id!r}',
                     branch.value.lineno,
-                    branch.value.col_offset,
-                    branch.value
+                    branch.value.func.id
                 )
-        elif type(branch) == ast.Assign:
-            for targ in branch.targets:
-                consts[targ.id] = _parse_arg(branch.value, None, consts)
         else:
             raise errors.UnsupportedSyntaxElement.create_custom(
                 'body',
-                branch.lineno,
-                branch.col_offset,
-                branch
+                branch.value.lineno,
+                branch.value.col_offset,
+                branch.value
             )
-    return result, macros, consts, reserved_labels
+    elif type(branch) == ast.Assign:
+        _assign_constant(branch, module.consts)
+    else:
+        raise errors.UnsupportedSyntaxElement.create_custom(
+            'body',
+            branch.lineno,
+            branch.col_offset,
+            branch
+        )
+
+
+def _parse_module(root: ast.Module, graph: ModuleGraph, filepath: str = None) -> Module:
+    module = Module()
+    module.filepath = filepath
+    module.body = []
+    module.macros = {}
+    module.consts = Constants()
+    module.reserved_labels = []
+    module.deps = {} if filepath is None else {filepath: cache.file_stamp(filepath)}
+    module.imports = {}
+    _declare_constants(root, module.consts)
+    if (collector := graph.collector) is None:
+        for branch in root.body:
+            _parse_toplevel(branch, graph, module)
+        return module
+    # keep going after an error: a failed top-level statement is skipped
+    outer_filename = collector.filename
+    collector.filename = filepath
+    try:
+        for branch in root.body:
+            try:
+                _parse_toplevel(branch, graph, module)
+            except errors.PyASMError as e:
+                collector.add(e)
+    finally:
+        collector.filename = outer_filename
+    return module
+
+
+def parse2(root: ast.Module, _graph: ModuleGraph = None) -> tuple[objasm.Program, MacroDict, ConstantDict, LabelList]:
+    if _graph is None:
+        _graph = ModuleGraph()
+    module = _graph.entry = _parse_module(root, _graph)
+    entry, library = _graph.link(module)
+    return objasm.Program(labels=entry + library), module.macros, module.consts, module.reserved_labels
 
 
-def parse(root: ast.Module) -> objasm.Program:
-    result, _, _, reserved_labels = parse2(root)
-    result.labels.append(objasm.Label(name='___hlt___', codes=[]))
-    for label in reserved_labels:
-        result.labels.append(objasm.Label(name=label, codes=[]))
-    return result
+def parse(root: ast.Module, library_origin: int = None, _graph: ModuleGraph = None) -> objasm.Program:
+    graph = _graph if _graph is not None else ModuleGraph()
+    module = graph.entry = _parse_module(root, graph)
+    if (prof := instrument.ACTIVE) is not None:
+        prof.enter('link')
+    entry, library = graph.link(module)
+    labels = entry + [objasm.Label(name=objasm.HALT_LABEL, codes=[])]
+    if library:
+        if library_origin is not None:
+            library[0] = library[0].with_codes(library[0].codes)
+            library[0].origin = library_origin
+        labels.extend(library)
+    # a module imported from several places contributes its labels only once
+    for label in dict.fromkeys(module.reserved_labels):
+        labels.append(objasm.Label(name=label, codes=[], reserve=1))
+    program = objasm.Program(labels=objasm.merge_empty_labels(labels))
+    if prof is not None:
+        prof.count('labels created', len(labels))
+        prof.leave()
+    return program
 
 
 if __name__ == '__main__':
@@ -0,0 +1,341 @@
+from typing import Union
+
+from pyasm import assemble, errors, objasm, opcodes
+
+DEFAULT_MAX_CYCLES = 100_000_000
+
+IMP, ACC, IMM, ZP, ZPX, ZPY, ABS, ABX, ABY, IND, IZX, IZY, REL = range(13)
+_MODE_IDS = {'imp': IMP, 'acc': ACC, 'imm': IMM, 'zp': ZP, 'zpx': ZPX, 'zpy': ZPY, 'abs': ABS,
+             'abx': ABX, 'aby': ABY, 'ind': IND, 'izx': IZX, 'izy': IZY, 'rel': REL}
+
+
+class LabelStats:
+    hits: int
+    cycles: int
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.cycles = 0
+
+
+class SimulationResult:
+    cycles: int
+    instructions: int
+    stop_reason: str
+    registers: dict[str, int]
+    labels: dict[str, LabelStats]
+    memory: bytearray
+    assembly: assemble.Assembly
+
+
+class CPU:
+    def __init__(self, memory: bytearray = None) -> None:
+        self.memory = memory if memory is not None else bytearray(0x10000)
+        self.a = self.x = self.y = 0
+        self.sp = 0xff
+        self.pc = 0
+        self.n = self.v = self.d = self.z = self.c = False
+        self.i = True
+        self.stop_reason = None
+        # opcode byte -> (handler, mode id, instruction size, base cycles, page-cross penalty)
+        self.decode: list = [None] * 256
+        for (opcode, (name, mode, cycles)) in opcodes.DECODE.items():
+            self.decode[opcode] = (getattr(self, '_op_' + name), _MODE_IDS[mode],
+                                   opcodes.MODE_SIZES[mode], cycles, name in opcodes.PAGE_PENALTY)
+
+    @property
+    def status(self) -> int:
+        return (self.n << 7 | self.v << 6 | 0x20 | self.d << 3 | self.i << 2 | self.z << 1 | self.c)
+
+    @status.setter
+    def status(self, value: int) -> None:
+        self.n = bool(value & 0x80)
+        self.v = bool(value & 0x40)
+        self.d = bool(value & 0x08)
+        self.i = bool(value & 0x04)
+        self.z = bool(value & 0x02)
+        self.c = bool(value & 0x01)
+
+    def _push(self, value: int) -> None:
+        self.memory[0x100 | self.sp] = value
+        self.sp = (self.sp - 1) & 0xff
+
+    def _pull(self) -> int:
+        self.sp = (self.sp + 1) & 0xff
+        return self.memory[0x100 | self.sp]
+
+    def _nz(self, value: int) -> int:
+        self.n = value >= 0x80
+        self.z = value == 0
+        return value
+
+    # Instruction handlers receive the effective address (None for implied and
+    # accumulator modes) and return extra cycles, if any.
+
+    def _add(self, value: int) -> None:
+        # binary mode only; decimal mode arithmetic is not modelled
+        a = self.a
+        result = a + value + self.c
+        self.c = result > 0xff
+        result &= 0xff
+        self.v = bool((a ^ result) & (value ^ result) & 0x80)
+        self.a = self._nz(result)
+
+    def _op_adc(self, addr): self._add(self.memory[addr])
+    def _op_sbc(self, addr): self._add(self.memory[addr] ^ 0xff)
+    def _op_and(self, addr): self.a = self._nz(self.a & self.memory[addr])
+    def _op_ora(self, addr): self.a = self._nz(self.a | self.memory[addr])
+    def _op_eor(self, addr): self.a = self._nz(self.a ^ self.memory[addr])
+
+    def _shift(self, addr, fn) -> None:
+        if addr is None:
+            self.a = self._nz(fn(self.a))
+        else:
+            self.memory[addr] = self._nz(fn(self.memory[addr]))
+
+    def _asl(self, value):
+        self.c = value >= 0x80
+        return (value << 1) & 0xff
+
+    def _lsr(self, value):
+        self.c = bool(value & 1)
+        return value >> 1
+
+    def _rol(self, value):
+        result = ((value << 1) | self.c) & 0xff
+        self.c = value >= 0x80
+        return result
+
+    def _ror(self, value):
+        result = (value >> 1) | (self.c << 7)
+        self.c = bool(value & 1)
+        return result
+
+    def _op_asl(self, addr): self._shift(addr, self._asl)
+    def _op_lsr(self, addr): self._shift(addr, self._lsr)
+    def _op_rol(self, addr): self._shift(addr, self._rol)
+    def _op_ror(self, addr): self._shift(addr, self._ror)
+
+    def _op_bit(self, addr):
+        value = self.memory[addr]
+        self.z = not (self.a & value)
+        self.n = value >= 0x80
+        self.v = bool(value & 0x40)
+
+    def _branch(self, taken: bool, addr: int) -> int:
+        if not taken:
+            return 0
+        extra = 1 if (self.pc ^ addr) & 0xff00 == 0 else 2
+        self.pc = addr
+        return extra
+
+    def _op_bcc(self, addr): return self._branch(not self.c, addr)
+    def _op_bcs(self, addr): return self._branch(self.c, addr)
+    def _op_beq(self, addr): return self._branch(self.z, addr)
+    def _op_bne(self, addr): return self._branch(not self.z, addr)
+    def _op_bmi(self, addr): return self._branch(self.n, addr)
+    def _op_bpl(self, addr): return self._branch(not self.n, addr)
+    def _op_bvc(self, addr): return self._branch(not self.v, addr)
+    def _op_bvs(self, addr): return self._branch(self.v, addr)
+
+    def _op_brk(self, addr): self.stop_reason = 'brk'
+    def _op_clc(self, addr): self.c = False
+    def _op_cld(self, addr): self.d = False
+    def _op_cli(self, addr): self.i = False
+    def _op_clv(self, addr): self.v = False
+    def _op_sec(self, addr): self.c = True
+    def _op_sed(self, addr): self.d = True
+    def _op_sei(self, addr): self.i = True
+
+    def _compare(self, reg: int, addr: int) -> None:
+        value = self.memory[addr]
+        self.c = reg >= value
+        self._nz((reg - value) & 0xff)
+
+    def _op_cmp(self, addr): self._compare(self.a, addr)
+    def _op_cpx(self, addr): self._compare(self.x, addr)
+    def _op_cpy(self, addr): self._compare(self.y, addr)
+
+    def _op_dec(self, addr): self.memory[addr] = self._nz((self.memory[addr] - 1) & 0xff)
+    def _op_inc(self, addr): self.memory[addr] = self._nz((self.memory[addr] + 1) & 0xff)
+    def _op_dex(self, addr): self.x = self._nz((self.x - 1) & 0xff)
+    def _op_dey(self, addr): self.y = self._nz((self.y - 1) & 0xff)
+    def _op_inx(self, addr): self.x = self._nz((self.x + 1) & 0xff)
+    def _op_iny(self, addr): self.y = self._nz((self.y + 1) & 0xff)
+
+    def _op_jmp(self, addr): self.pc = addr
+
+    def _op_jsr(self, addr):
+        ret = (self.pc - 1) & 0xffff
+        self._push(ret >> 8)
+        self._push(ret & 0xff)
+        self.pc = addr
+
+    def _op_rts(self, addr):
+        if self.sp == 0xff:
+            # returning from the entry point ends the program
+            self.stop_reason = 'rts'
+            return
+        lo = self._pull()
+        self.pc = ((self._pull() << 8 | lo) + 1) & 0xffff
+
+    def _op_rti(self, addr):
+        self.status = self._pull()
+        lo = self._pull()
+        self.pc = self._pull() << 8 | lo
+
+    def _op_lda(self, addr): self.a = self._nz(self.memory[addr])
+    def _op_ldx(self, addr): self.x = self._nz(self.memory[addr])
+    def _op_ldy(self, addr): self.y = self._nz(self.memory[addr])
+    def _op_sta(self, addr): self.memory[addr] = self.a
+    def _op_stx(self, addr): self.memory[addr] = self.x
+    def _op_sty(self, addr): self.memory[addr] = self.y
+    def _op_nop(self, addr): pass
+
+    def _op_pha(self, addr): self._push(self.a)
+    def _op_php(self, addr): self._push(self.status | 0x10)
+    def _op_pla(self, addr): self.a = self._nz(self._pull())
+    def _op_plp(self, addr): self.status = self._pull()
+
+    def _op_tax(self, addr): self.x = self._nz(self.a)
+    def _op_tay(self, addr): self.y = self._nz(self.a)
+    def _op_tsx(self, addr): self.x = self._nz(self.sp)
+    def _op_txa(self, addr): self.a = self._nz(self.x)
+    def _op_txs(self, addr): self.sp = self.x
+    def _op_tya(self, addr): self.a = self._nz(self.y)
+
+
+def simulate(program: Union[objasm.Program, assemble.Assembly], origin: int = assemble.DEFAULT_ORIGIN,
+             max_cycles: int = DEFAULT_MAX_CYCLES) -> SimulationResult:
+    if isinstance(program, assemble.Assembly):
+        assembly = program
+    else:
+        assembly = assemble.assemble(program, origin)
+    cpu = CPU()
+    mem = cpu.memory
+    mem[assembly.origin:assembly.origin + len(assembly.data)] = assembly.data
+    cpu.pc = assembly.origin
+    halt = assembly.labels.get(objasm.HALT_LABEL, -1)
+
+    # Several empty labels can share an address; statistics go to the last one,
+    # which is the label that owns the code found there.
+    names = ['<outside>']
+    starts = {}
+    for (name, address) in sorted(assembly.labels.items(), key=lambda item: item[1]):
+        starts[address] = len(names)
+        names.append(name)
+    label_start = [0] * 0x10000
+    owner = [0] * 0x10000
+    current = 0
+    end = assembly.origin + len(assembly.data)
+    for address in range(assembly.origin, end):
+        if address in starts:
+            current = label_start[address] = starts[address]
+        owner[address] = current
+    hits = [0] * len(names)
+    label_cycles = [0] * len(names)
+
+    decode = cpu.decode
+    cycles = 0
+    instructions = 0
+    stop_reason = 'cycle limit'
+    while cycles < max_cycles:
+        pc = cpu.pc
+        if pc == halt:
+            stop_reason = 'halt'
+            break
+        if (start := label_start[pc]):
+            hits[start] += 1
+        entry = decode[mem[pc]]
+        if entry is None:
+            raise errors.SimulationError.create_custom(f'illegal opcode ${mem[pc]:02x}', pc)
+        handler, mode, size, spent, penalty = entry
+
+        if mode <= ACC:
+            addr = None
+        elif mode == IMM:
+            addr = pc + 1
+        elif mode == ABS:
+            addr = mem[pc + 1] | mem[pc + 2] << 8
+        elif mode == ZP:
+            addr = mem[pc + 1]
+        elif mode == REL:
+            offset = mem[pc + 1]
+            addr = (pc + 2 + offset - (offset >= 0x80) * 0x100) & 0xffff
+        elif mode == ZPX:
+            addr = (mem[pc + 1] + cpu.x) & 0xff
+        elif mode == ZPY:
+            addr = (mem[pc + 1] + cpu.y) & 0xff
+        elif mode == ABX or mode == ABY:
+            base = mem[pc + 1] | mem[pc + 2] << 8
+            addr = (base + (cpu.x if mode == ABX else cpu.y)) & 0xffff
+            if penalty and (base ^ addr) & 0xff00:
+                spent += 1
+        elif mode == IND:
+            ptr = mem[pc + 1] | mem[pc + 2] << 8
+            # the NMOS 6502 never carries into the high byte of the pointer
+            addr = mem[ptr] | mem[(ptr & 0xff00) | ((ptr + 1) & 0xff)] << 8
+        elif mode == IZX:
+            zp = (mem[pc + 1] + cpu.x) & 0xff
+            addr = mem[zp] | mem[(zp + 1) & 0xff] << 8
+        else:
+            zp = mem[pc + 1]
+            base = mem[zp] | mem[(zp + 1) & 0xff] << 8
+            addr = (base + cpu.y) & 0xffff
+            if penalty and (base ^ addr) & 0xff00:
+                spent += 1
+
+        cpu.pc = (pc + size) & 0xffff
+        extra = handler(addr)
+        if extra:
+            spent += extra
+        cycles += spent
+        instructions += 1
+        label_cycles[owner[pc]] += spent
+        if cpu.stop_reason is not None:
+            stop_reason = cpu.stop_reason
+            break
+
+    result = SimulationResult()
+    result.cycles = cycles
+    result.instructions = instructions
+    result.stop_reason = stop_reason
+    result.registers = {'a': cpu.a, 'x': cpu.x, 'y': cpu.y, 'sp': cpu.sp, 'pc': cpu.pc, 'p': cpu.status}
+    result.labels = {}
+    for (ix, name) in enumerate(names):
+        if ix and (hits[ix] or label_cycles[ix]):
+            stats = result.labels[name] = LabelStats()
+            stats.hits = hits[ix]
+            stats.cycles = label_cycles[ix]
+    result.memory = mem
+    result.assembly = assembly
+    return result
+
+
+def format_report(result: SimulationResult, data_labels: list[str] = ()) -> str:
+    regs = result.registers
+    lines = [
+        f'stopped by: {result.stop_reason}',
+        f'cycles: {result.cycles}',
+        f'instructions: {result.instructions}',
+        'registers: ' + ' '.join(f'{name.upper()}=${value:0{4 if name == "pc" else 2}x}'
+                                 for (name, value) in regs.items()),
+        '',
+        f'{"label":32} {"hits":>10} {"cycles":>12}',
+    ]
+    for (name, stats) in sorted(result.labels.items(), key=lambda item: -item[1].cycles):
+        lines.append(f'{name:32} {stats.hits:10} {stats.cycles:12}')
+    if data_labels:
+        lines.append('')
+        for name in data_labels:
+            value = result.memory[result.assembly.labels[name]]
+            lines.append(f'{name} = ${value:02x} ({value})')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from pyasm import parse
+    import ast
+    import sys
+    program = parse.parse(ast.parse(open(sys.argv[1]).read()))
+    print(format_report(simulate(program), [label.name for label in program.labels if label.reserve]))
@@ -13,6 +13,11 @@ proc = 'proc'
 Register = Literal[regx, regy, accum, proc]
 
 def inline_macro(macro: Macro) -> Macro: ...
+def constant_result(reg: Register, val: int) -> Callable[[Macro], Macro]: ...
+def prefer_inline(label: Label) -> Label: ...
+
+def lo(val: int) -> int: ...
+def hi(val: int) -> int: ...
 
 
 def jump(label: Referenceable): ...
@@ -21,11 +26,26 @@ def halt(): ...
 def add_memory(addr: Referenceable): ...
 def add_value(addr: Referenceable): ...
 def increment_memory(addr: Referenceable): ...
+def decrement_memory(addr: Referenceable): ...
+def shift_left_memory(addr: Referenceable): ...
+def shift_right_memory(addr: Referenceable): ...
+def rotate_left_memory(addr: Referenceable): ...
+def rotate_right_memory(addr: Referenceable): ...
+
+def shift_left(): ...
+def shift_right(): ...
+def rotate_left(): ...
+def rotate_right(): ...
+def clear_carry(): ...
+def set_carry(): ...
 
 def push(reg: Register): ...
 def pull(reg: Register): ...
-def increment_register(reg: Register, addr: Referenceable): ...
-def store_register(reg: Register, addr: Referenceable)
+def increment_register(reg: Register): ...
+def decrement_register(reg: Register): ...
+def transfer_from_accum(reg: Register): ...
+def transfer_to_accum(reg: Register): ...
+def store_register(reg: Register, addr: Referenceable): ...
 
 def load_immediate(reg: Register, val: int): ...
 def load_address(reg: Register, addr: Address): ...
@@ -36,5 +56,7 @@ def branch_plus(label: Referenceable): ...
 def branch_minus(label: Referenceable): ...
 def branch_ne(label: Referenceable): ...
 def branch_eq(label: Referenceable): ...
+def branch_carry_clear(label: Referenceable): ...
+def branch_carry_set(label: Referenceable): ...
 
 def compare(reg: Register, addr: Address): ...
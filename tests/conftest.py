@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # keep the module cache of every test apart from the user's
+    monkeypatch.setenv('PYASM_CACHE_DIR', str(tmp_path / 'pyasm-cache'))
+    return tmp_path / 'pyasm-cache'
@@ -0,0 +1,30 @@
+import io
+import multiprocessing
+
+from pyasm import cache, driver
+
+SOURCE = '''from pyasm.stubs import *
+from math import *
+
+def start():
+    load_immediate(regx, 3)
+    load_immediate(regy, 5)
+    call(multiply)
+    halt()
+'''
+
+
+def test_batch_workers_honor_no_cache(tmp_path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv('PYASM_CACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(cache, 'ENABLED', False)
+    paths = []
+    for name in ('a', 'b'):
+        path = tmp_path / f'{name}.pyasm'
+        path.write_text(SOURCE)
+        paths.append(str(path))
+    options = driver.Options(output_dir=str(tmp_path / 'out'))
+    out = io.StringIO()
+    failures = driver.run_batch(paths, options, 2, out, mp_context=multiprocessing.get_context('spawn'))
+    assert failures == 0, out.getvalue()
+    assert not cache_dir.exists() or not any(cache_dir.iterdir())
@@ -0,0 +1,60 @@
+from pyasm import driver
+
+
+def compile_codes(source: str, opt_level: int = 2) -> list[tuple[str, list[str]]]:
+    result = driver.compile_source(source, '<test>', driver.Options(opt_level=opt_level))
+    return [(op.op, op.args) for label in result.program.labels for op in label.codes]
+
+
+def test_io_register_reads_are_kept():
+    # strobing the controller port and reading it back must not fold the read
+    # into the value stored last
+    codes = compile_codes('''from pyasm.stubs import *
+
+JOY1 = 0x4016
+
+def start():
+    load_immediate(accum, 1)
+    store_register(accum, JOY1)
+    load_immediate(accum, 0)
+    store_register(accum, JOY1)
+    load_address(accum, JOY1)
+    store_register(accum, buttons)
+    halt()
+
+
+reserve_label('buttons')
+''')
+    assert codes[:6] == [
+        ('lda', ['#1']), ('sta', ['16406']), ('lda', ['#0']), ('sta', ['16406']),
+        ('lda', ['16406']), ('sta', ['buttons']),
+    ]
+
+
+def test_io_register_stores_are_kept():
+    codes = compile_codes('''from pyasm.stubs import *
+
+def start():
+    load_immediate(accum, 0)
+    store_register(accum, 0x2005)
+    store_register(accum, 0x2005)
+    halt()
+''')
+    assert codes.count(('sta', ['8197'])) == 2
+
+
+def test_label_stores_are_tracked():
+    codes = compile_codes('''from pyasm.stubs import *
+
+def start():
+    load_immediate(accum, 0)
+    store_register(accum, value)
+    store_register(accum, value)
+    load_address(accum, value)
+    halt()
+
+
+reserve_label('value')
+''')
+    assert codes.count(('sta', ['value'])) == 1
+    assert ('lda', ['value']) not in codes
@@ -0,0 +1,46 @@
+import ast
+
+from pyasm import parse
+
+WRAPPERS = '''from pyasm.stubs import *
+from math import *
+
+@inline_macro
+def sq_plus(x):
+    square(x)
+    add_value(1)
+
+@inline_macro
+def sq_then_mult(x, y):
+    sq_plus(x)
+    mult(x, y)
+
+def start():
+    {body}
+    halt()
+
+def table():
+    return
+'''
+
+
+def parse_codes(body: str) -> list[tuple[str, list[str]]]:
+    program = parse.parse(ast.parse(WRAPPERS.format(body=body)))
+    return [(op.op, op.args) for op in program.labels[0].codes]
+
+
+def test_constant_result_folds_inside_wrapper_macros():
+    assert parse_codes('sq_plus(3)') == [('lda', ['#9']), ('adc', ['#1']), ('jmp', ['___hlt___'])]
+    assert parse_codes('sq_then_mult(4, 5)') == [
+        ('lda', ['#16']), ('adc', ['#1']), ('lda', ['#20']), ('jmp', ['___hlt___']),
+    ]
+
+
+def test_wrapper_macros_call_multiply_for_labels():
+    codes = parse_codes('sq_plus(table)')
+    assert ('jsr', ['multiply']) in codes
+    assert all(op != parse.FOLD_MARK for (op, _) in codes)
+
+
+def test_every_builtin_has_a_matching_stub():
+    assert parse.check_stubs() == []